@@ -6,7 +6,23 @@ Replace "pass" with your code.
 
 import simpleplot
 import comp140_module4 as movies
-from collections import defaultdict
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
 
 # Below is the class for queue
 class Queue:
@@ -18,7 +34,7 @@ class Queue:
         """
         Initialize the queue.
         """
-        self._queue_list = []
+        self._queue_list = deque()
 
     def __len__(self):
         """
@@ -30,7 +46,7 @@ class Queue:
         """
         Returns a string representation of the queue.
         """
-        return str(self._queue_list)
+        return str(list(self._queue_list))
 
     def push(self, item):
         """
@@ -46,13 +62,13 @@ class Queue:
         is an error if there is not.  You do not need to check for
         this condition.
         """
-        return self._queue_list.pop(0)
+        return self._queue_list.popleft()
 
     def clear(self):
         """
         Remove all items from the queue.
         """
-        self._queue_list = []
+        self._queue_list = deque()
 
 #queue1 = Queue()
 #queue1.push(1)
@@ -60,6 +76,316 @@ class Queue:
 #print queue1.pop()
 #print str(queue1)
 
+# Below is the class for a compact copy of the graph
+class CSRGraph:
+    """
+    A read-only copy of an actor graph stored in flat integer arrays.
+
+    Actors are interned to IDs 0..n-1 and the neighbors of actor i are
+    neighbor_ids[offsets[i]:offsets[i + 1]] (compressed sparse row
+    form).  The movies on each edge are kept apart in the same form,
+    so searches only ever touch the two integer arrays.
+    """
+
+    def __init__(self, graph=None, order=None):
+        """
+        Create a compact copy of graph, giving the actors IDs in the
+        order of the list order if given, else of graph.nodes().  With
+        no graph the copy is empty, ready for open_snapshot.
+        """
+        self._names = []
+        self._ids = {}
+        self._offsets = array('i', [0])
+        self._neighbor_ids = array('i')
+        # Movies are interned too; edge e has the movies
+        # edge_movies[movie_offsets[e]:movie_offsets[e + 1]]
+        self._movies = []
+        movie_ids = {}
+        self._movie_offsets = array('i', [0])
+        self._edge_movies = array('i')
+        if graph is None:
+            return
+        if order is None:
+            order = graph.nodes()
+        self._names = list(order)
+        for node_id in range(len(self._names)):
+            self._ids[self._names[node_id]] = node_id
+        for node in self._names:
+            for neighbor in graph.get_neighbors(node):
+                self._neighbor_ids.append(self._ids[neighbor])
+                for movie in graph.get_attrs(node, neighbor):
+                    if movie not in movie_ids:
+                        movie_ids[movie] = len(self._movies)
+                        self._movies.append(movie)
+                    self._edge_movies.append(movie_ids[movie])
+                self._movie_offsets.append(len(self._edge_movies))
+            self._offsets.append(len(self._neighbor_ids))
+
+    def __len__(self):
+        """
+        Return the number of actors in the graph.
+        """
+        return len(self._names)
+
+    def nodes(self):
+        """
+        Return a list of the actors in the graph.
+        """
+        return list(self._names)
+
+    def get_neighbors(self, node):
+        """
+        Return a list of the neighbors of node.
+        """
+        node_id = self._ids[node]
+        return [self._names[neighbor_id] for neighbor_id in
+                self._neighbor_ids[self._offsets[node_id]:self._offsets[node_id + 1]]]
+
+    def get_attrs(self, node1, node2):
+        """
+        Return the set of movies on the edge between node1 and node2.
+        """
+        node_id1 = self._ids[node1]
+        node_id2 = self._ids[node2]
+        for edge in range(self._offsets[node_id1], self._offsets[node_id1 + 1]):
+            if self._neighbor_ids[edge] == node_id2:
+                return set([self._movies[movie_id] for movie_id in
+                            self._edge_movies[self._movie_offsets[edge]:self._movie_offsets[edge + 1]]])
+        raise KeyError((node1, node2))
+
+    def node_id(self, node):
+        """
+        Return the integer ID of node.
+        """
+        return self._ids[node]
+
+    def node_name(self, node_id):
+        """
+        Return the actor with the given integer ID.
+        """
+        return self._names[node_id]
+
+class IdArrayView:
+    """
+    A read-only, dictionary-like view of an array indexed by actor ID,
+    keyed by actor name.  Values are translated when they are read,
+    so nothing is built for actors that are never looked up.
+    """
+
+    def __init__(self, graph, values, translate):
+        """
+        Create a view of values, an array indexed by the IDs of the
+        CSRGraph graph; translate turns a stored value into the value
+        returned.
+        """
+        self._graph = graph
+        self._values = values
+        self._translate = translate
+
+    def __getitem__(self, node):
+        """
+        Return the translated value for node.
+        """
+        return self._translate(self._values[self._graph.node_id(node)])
+
+    def __contains__(self, node):
+        """
+        Return True if node is in the graph.
+        """
+        return node in self._graph._ids
+
+    def __len__(self):
+        """
+        Return the number of actors in the graph.
+        """
+        return len(self._values)
+
+    def __iter__(self):
+        """
+        Iterate over the actors in the graph.
+        """
+        return iter(self._graph._names)
+
+    def keys(self):
+        """
+        Return a list of the actors in the graph.
+        """
+        return self._graph.nodes()
+
+    def get(self, node, default=None):
+        """
+        Return the translated value for node, or default if node is not
+        in the graph.
+        """
+        if node in self:
+            return self[node]
+        return default
+
+    def items(self):
+        """
+        Return a list of (actor, translated value) pairs.
+        """
+        return [(self._graph.node_name(node_id), self._translate(self._values[node_id]))
+                for node_id in range(len(self._values))]
+
+def bfs_ids(csr_graph, start_id):
+    """
+    Performs a breadth-first search on the CSRGraph csr_graph starting
+    at the actor with ID start_id.
+
+    Returns a two-element tuple of integer arrays indexed by actor ID:
+    the distance of each actor from the start and the ID of its
+    parent, with -1 for actors that were not reached (and for the
+    start's parent).
+    """
+    return bfs_arrays(csr_graph._offsets, csr_graph._neighbor_ids, start_id)
+
+def bfs_arrays(offsets, neighbor_ids, start_id):
+    """
+    Performs the search of bfs_ids directly on CSR offset and neighbor
+    arrays, which may be any integer sequences (such as shared memory).
+    """
+    count = len(offsets) - 1
+    dist = array('i', [-1]) * count
+    parent = array('i', [-1]) * count
+    # Every actor is queued at most once, so a fixed array with head
+    # and tail indices never needs to wrap
+    frontier = array('i', [0]) * count
+    dist[start_id] = 0
+    frontier[0] = start_id
+    head = 0
+    tail = 1
+    while head < tail:
+        node_id = frontier[head]
+        head += 1
+        next_dist = dist[node_id] + 1
+        for edge in range(offsets[node_id], offsets[node_id + 1]):
+            neighbor_id = neighbor_ids[edge]
+            if dist[neighbor_id] < 0:
+                dist[neighbor_id] = next_dist
+                parent[neighbor_id] = node_id
+                frontier[tail] = neighbor_id
+                tail += 1
+    return dist, parent
+
+def distance_value(stored):
+    """
+    Translate a stored distance into the value bfs uses.
+    """
+    if stored < 0:
+        return float("inf")
+    return stored
+
+def id_views(csr_graph, dist, parent):
+    """
+    Return the two-element tuple of views that csr_bfs returns, over
+    the distance and parent arrays indexed by the IDs of the CSRGraph
+    csr_graph.
+    """
+    def parent_value(stored):
+        """
+        Translate a stored parent ID into the actor bfs uses.
+        """
+        if stored < 0:
+            return None
+        return csr_graph.node_name(stored)
+    return (IdArrayView(csr_graph, dist, distance_value),
+            IdArrayView(csr_graph, parent, parent_value))
+
+def csr_bfs(csr_graph, start_node):
+    """
+    Performs a breadth-first search on the CSRGraph csr_graph starting
+    at start_node, over its integer arrays.
+
+    Returns the same two-element tuple as bfs, except that the
+    dictionaries are views that translate IDs back into actor names
+    only when they are read.
+    """
+    dist, parent = bfs_ids(csr_graph, csr_graph.node_id(start_node))
+    return id_views(csr_graph, dist, parent)
+
+#csr_graph = CSRGraph(movies.load_graph('subgraph5000'))
+#print csr_bfs(csr_graph, 'Kevin Bacon')[0]['Amy Adams']
+
+def direction_optimizing_bfs_ids(csr_graph, start_id, alpha=14, beta=24):
+    """
+    Performs a breadth-first search on the CSRGraph csr_graph starting
+    at the actor with ID start_id, one whole level at a time.
+
+    Small levels are expanded top-down (each frontier actor marks its
+    unvisited neighbors).  Once the edges leaving the frontier exceed
+    1/alpha of the edges of unvisited actors, levels are expanded
+    bottom-up instead (each unvisited actor looks for any neighbor in
+    the frontier and stops at the first), until the frontier shrinks
+    below 1/beta of the actors.
+
+    Returns a three-element tuple of the distance and parent arrays,
+    as bfs_ids returns, and a list of the number of actors at each
+    level.  Distances match bfs_ids; on bottom-up levels the parent
+    may be a different actor on the level above.
+    """
+    offsets = csr_graph._offsets
+    neighbor_ids = csr_graph._neighbor_ids
+    count = len(csr_graph)
+    dist = array('i', [-1]) * count
+    parent = array('i', [-1]) * count
+    # Flags for the actors in the current frontier
+    in_frontier = bytearray(count)
+    dist[start_id] = 0
+    frontier = array('i', [start_id])
+    level_sizes = []
+    level = 0
+    unvisited_edges = len(neighbor_ids) - (offsets[start_id + 1] - offsets[start_id])
+    bottom_up = False
+    while frontier:
+        level_sizes.append(len(frontier))
+        level += 1
+        frontier_edges = 0
+        for node_id in frontier:
+            frontier_edges += offsets[node_id + 1] - offsets[node_id]
+        if bottom_up:
+            bottom_up = len(frontier) * beta >= count
+        else:
+            bottom_up = frontier_edges * alpha > unvisited_edges
+        next_frontier = array('i')
+        if bottom_up:
+            for node_id in frontier:
+                in_frontier[node_id] = 1
+            for node_id in range(count):
+                if dist[node_id] >= 0:
+                    continue
+                for edge in range(offsets[node_id], offsets[node_id + 1]):
+                    neighbor_id = neighbor_ids[edge]
+                    if in_frontier[neighbor_id]:
+                        dist[node_id] = level
+                        parent[node_id] = neighbor_id
+                        next_frontier.append(node_id)
+                        break
+            for node_id in frontier:
+                in_frontier[node_id] = 0
+        else:
+            for node_id in frontier:
+                for edge in range(offsets[node_id], offsets[node_id + 1]):
+                    neighbor_id = neighbor_ids[edge]
+                    if dist[neighbor_id] < 0:
+                        dist[neighbor_id] = level
+                        parent[neighbor_id] = node_id
+                        next_frontier.append(neighbor_id)
+        for node_id in next_frontier:
+            unvisited_edges -= offsets[node_id + 1] - offsets[node_id]
+        frontier = next_frontier
+    return dist, parent, level_sizes
+
+def direction_optimizing_bfs(csr_graph, start_node):
+    """
+    Performs a direction-optimizing breadth-first search on the
+    CSRGraph csr_graph starting at start_node.
+
+    Returns the same two-element tuple of views as csr_bfs.
+    """
+    dist, parent, level_sizes = direction_optimizing_bfs_ids(csr_graph, csr_graph.node_id(start_node))
+    return id_views(csr_graph, dist, parent)
+
 
 def bfs(graph, start_node):
     """
@@ -71,6 +397,8 @@ def bfs(graph, start_node):
     was visited and a dictionary associating each visited node
     with its parent node.
     """
+    if isinstance(graph, CSRGraph):
+        return csr_bfs(graph, start_node)
     queue = Queue()
     dist = {}
     parent = {}
@@ -91,12 +419,403 @@ def bfs(graph, start_node):
     return dist, parent
 
 
-def distance_histogram(graph, node):
+def bfs_levels(graph, start_node, max_depth=None, max_visited=None, parent=None):
+    """
+    Performs a breadth-first search on graph starting at the
+    start_node, yielding a (level, nodes_at_level) tuple for each
+    level as it is reached, in the order bfs visits them.
+
+    The search stops after level max_depth, or once max_visited nodes
+    have been visited (cutting the last level short), if given.  Only
+    visited nodes are recorded: if a parent dictionary is given, each
+    visited node is associated with its parent node in it, as bfs
+    would.
+    """
+    if parent is None:
+        parent = {}
+    if isinstance(graph, CSRGraph):
+        for level, nodes in csr_bfs_levels(graph, start_node, max_depth, max_visited, parent):
+            yield level, nodes
+        return
+    parent[start_node] = None
+    visited = 1
+    level = 0
+    frontier = [start_node]
+    yield level, frontier
+    while frontier:
+        if max_depth is not None and level >= max_depth:
+            return
+        if max_visited is not None and visited >= max_visited:
+            return
+        level += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor in graph.get_neighbors(node):
+                if neighbor not in parent:
+                    parent[neighbor] = node
+                    next_frontier.append(neighbor)
+                    visited += 1
+                    if max_visited is not None and visited >= max_visited:
+                        break
+            if max_visited is not None and visited >= max_visited:
+                break
+        if not next_frontier:
+            return
+        yield level, next_frontier
+        frontier = next_frontier
+
+def csr_bfs_levels(csr_graph, start_node, max_depth, max_visited, parent):
+    """
+    Performs the search of bfs_levels on the CSRGraph csr_graph over
+    its integer arrays, looking up the name of each actor only once,
+    when it is visited.  Like bfs_levels, it only keeps state for the
+    actors it visits.
+    """
+    offsets = csr_graph._offsets
+    neighbor_ids = csr_graph._neighbor_ids
+    # IDs of the visited actors, and of any the caller already recorded
+    seen = set([])
+    for node in parent:
+        if node in csr_graph._ids:
+            seen.add(csr_graph.node_id(node))
+    start_id = csr_graph.node_id(start_node)
+    seen.add(start_id)
+    parent[start_node] = None
+    visited = 1
+    level = 0
+    frontier_ids = [start_id]
+    frontier = [start_node]
+    yield level, frontier
+    while frontier:
+        if max_depth is not None and level >= max_depth:
+            return
+        if max_visited is not None and visited >= max_visited:
+            return
+        level += 1
+        next_frontier_ids = []
+        next_frontier = []
+        for index in range(len(frontier_ids)):
+            node_id = frontier_ids[index]
+            for edge in range(offsets[node_id], offsets[node_id + 1]):
+                neighbor_id = neighbor_ids[edge]
+                if neighbor_id not in seen:
+                    seen.add(neighbor_id)
+                    neighbor = csr_graph.node_name(neighbor_id)
+                    parent[neighbor] = frontier[index]
+                    next_frontier_ids.append(neighbor_id)
+                    next_frontier.append(neighbor)
+                    visited += 1
+                    if max_visited is not None and visited >= max_visited:
+                        break
+            if max_visited is not None and visited >= max_visited:
+                break
+        if not next_frontier:
+            return
+        yield level, next_frontier
+        frontier_ids = next_frontier_ids
+        frontier = next_frontier
+
+#for level, nodes in bfs_levels(graph, 'Kevin Bacon', 2):
+#    print level, len(nodes)
+
+def repair_bfs(graph, dist, parent, new_edges):
+    """
+    Repairs the result of a breadth-first search on graph after the
+    edges in new_edges, a list of (actor1, actor2) pairs, have been
+    added to it.
+
+    dist and parent are the dictionaries returned by bfs, and are
+    updated in place.  Only actors whose distance improves are
+    revisited, level by level from the new edges outwards.  The
+    distances then match a fresh bfs; an actor whose distance improves
+    gets a parent on the level above, which may not be the one a
+    fresh bfs would pick.
+
+    The read-only views bfs returns for a CSRGraph cannot be repaired
+    here; use BFSCache.add_edges for cached results instead.
+
+    Returns the two-element tuple (dist, parent).
+    """
+    if isinstance(dist, IdArrayView) or isinstance(parent, IdArrayView):
+        raise TypeError("repair_bfs needs dictionaries, not read-only views; "
+                        "use BFSCache.add_edges to repair cached results")
+    infinity = float("inf")
+    # Actors to revisit, grouped by their new distance
+    buckets = defaultdict(list)
+    for node1, node2 in new_edges:
+        for near, far in ((node1, node2), (node2, node1)):
+            # Actors new to the graph start out unreached
+            if far not in dist:
+                dist[far] = infinity
+                parent[far] = None
+            near_dist = dist.get(near, infinity)
+            if near_dist + 1 < dist[far]:
+                dist[far] = near_dist + 1
+                parent[far] = near
+                buckets[near_dist + 1].append(far)
+    while buckets:
+        level = min(buckets.keys())
+        for node in buckets.pop(level):
+            # Skip actors that were improved again after being queued
+            if dist[node] != level:
+                continue
+            for neighbor in graph.get_neighbors(node):
+                if level + 1 < dist.get(neighbor, infinity):
+                    dist[neighbor] = level + 1
+                    parent[neighbor] = node
+                    buckets[level + 1].append(neighbor)
+    return dist, parent
+
+def repair_bfs_ids(csr_graph, dist, parent, new_edge_ids):
+    """
+    Performs the repair of repair_bfs on the distance and parent
+    arrays that bfs_ids returned, updating them in place.  csr_graph
+    must already hold the new edges, given as (ID, ID) pairs in
+    new_edge_ids, and give every actor the ID it had in the arrays.
+    """
+    offsets = csr_graph._offsets
+    neighbor_ids = csr_graph._neighbor_ids
+    # Actors to revisit, grouped by their new distance
+    buckets = defaultdict(list)
+    for node_id1, node_id2 in new_edge_ids:
+        for near_id, far_id in ((node_id1, node_id2), (node_id2, node_id1)):
+            if dist[near_id] >= 0 and (dist[far_id] < 0 or dist[near_id] + 1 < dist[far_id]):
+                dist[far_id] = dist[near_id] + 1
+                parent[far_id] = near_id
+                buckets[dist[far_id]].append(far_id)
+    while buckets:
+        level = min(buckets.keys())
+        for node_id in buckets.pop(level):
+            # Skip actors that were improved again after being queued
+            if dist[node_id] != level:
+                continue
+            for edge in range(offsets[node_id], offsets[node_id + 1]):
+                neighbor_id = neighbor_ids[edge]
+                if dist[neighbor_id] < 0 or level + 1 < dist[neighbor_id]:
+                    dist[neighbor_id] = level + 1
+                    parent[neighbor_id] = node_id
+                    buckets[level + 1].append(neighbor_id)
+    return dist, parent
+
+def array_bytes(arrays):
+    """
+    Return the number of bytes held by the items of the given arrays.
+    """
+    return sum([values.itemsize * len(values) for values in arrays])
+
+def csr_bytes(csr_graph):
+    """
+    Return the number of bytes held by the integer arrays of the
+    CSRGraph csr_graph.
+    """
+    return array_bytes([csr_graph._offsets, csr_graph._neighbor_ids,
+                        csr_graph._movie_offsets, csr_graph._edge_movies])
+
+class BFSCache:
+    """
+    A least-recently-used cache of breadth-first search results, keyed
+    by graph version and start actor.
+
+    Results are kept as compact distance and parent arrays over a
+    CSRGraph copy of each graph.  The least recently used results are
+    evicted once the results and copies take more than max_bytes, and
+    a graph's copy is dropped with its last result.  Call add_edges
+    after adding edges to a graph, or invalidate after any other
+    change, so that stale results are never served.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        Create an empty cache holding at most max_bytes of results.
+        """
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        # Maps (graph ID, version, start actor) to (dist, parent) arrays
+        self._entries = OrderedDict()
+        # Maps graph ID to [version, graph, CSRGraph copy, size of the
+        # copy, number of results] while it has results cached; holding
+        # the graph stops its ID being reused meanwhile
+        self._graphs = {}
+        # Every record gets a new version, so results never outlive it
+        self._next_version = 1
+
+    def __len__(self):
+        """
+        Return the number of cached results.
+        """
+        return len(self._entries)
+
+    def get_version(self, graph):
+        """
+        Return the version the cache holds for graph, or 0 if it has
+        nothing cached for graph.  The version changes whenever graph
+        is invalidated.
+        """
+        record = self._graphs.get(id(graph))
+        if record is None:
+            return 0
+        return record[0]
+
+    def invalidate(self, graph):
+        """
+        Drop every result cached for graph, and its CSRGraph copy,
+        after it has changed.
+        """
+        graph_key = id(graph)
+        for key in list(self._entries.keys()):
+            if key[0] == graph_key:
+                self._drop(key)
+        self._release(graph_key)
+
+    def add_edges(self, graph, new_edges):
+        """
+        Repair every result cached for graph after the edges in
+        new_edges, a list of (actor1, actor2) pairs, have been added to
+        it, instead of dropping them as invalidate does.  The CSRGraph
+        copy is rebuilt once, keeping every actor's ID, and each result
+        then only revisits the actors whose distance improves.
+        """
+        record = self._graphs.get(id(graph))
+        if record is None:
+            return
+        if isinstance(graph, CSRGraph):
+            raise TypeError("a CSRGraph cannot gain edges")
+        old_graph = record[2]
+        # New actors get the IDs after the existing ones
+        order = list(old_graph._names)
+        for node in graph.nodes():
+            if node not in old_graph._ids:
+                order.append(node)
+        csr_graph = CSRGraph(graph, order)
+        added = len(csr_graph) - len(old_graph)
+        self._bytes += csr_bytes(csr_graph) - record[3]
+        record[2] = csr_graph
+        record[3] = csr_bytes(csr_graph)
+        new_edge_ids = [(csr_graph.node_id(node1), csr_graph.node_id(node2))
+                        for node1, node2 in new_edges]
+        for key in list(self._entries.keys()):
+            if key[0] == id(graph):
+                dist, parent = self._entries[key]
+                if added:
+                    dist.extend(array('i', [-1]) * added)
+                    parent.extend(array('i', [-1]) * added)
+                    self._bytes += 2 * added * dist.itemsize
+                repair_bfs_ids(csr_graph, dist, parent, new_edge_ids)
+        while self._bytes > self._max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+
+    def bfs(self, graph, start_node):
+        """
+        Performs a breadth-first search on graph starting at
+        start_node, or reuses a cached one.
+
+        Returns the same two-element tuple of views as csr_bfs.
+        """
+        csr_graph, dist, parent = self.get_arrays(graph, start_node)
+        return id_views(csr_graph, dist, parent)
+
+    def get_arrays(self, graph, start_node):
+        """
+        Performs a breadth-first search on graph starting at
+        start_node, or reuses a cached one.
+
+        Returns a three-element tuple of the CSRGraph copy of graph and
+        the distance and parent arrays that bfs_ids returns on it.
+        """
+        record = self._record(graph)
+        csr_graph = record[2]
+        key = (id(graph), record[0], start_node)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = bfs_ids(csr_graph, csr_graph.node_id(start_node))
+            size = array_bytes(entry)
+            if size + record[3] <= self._max_bytes:
+                self._entries[key] = entry
+                self._bytes += size
+                record[4] += 1
+                while self._bytes > self._max_bytes:
+                    self._drop(next(iter(self._entries)))
+            elif record[4] == 0:
+                # Nothing of graph fits, so do not keep its copy either
+                self._release(id(graph))
+        else:
+            # Mark the entry as the most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+        return csr_graph, entry[0], entry[1]
+
+    def _record(self, graph):
+        """
+        Return the record of graph, making one with a CSRGraph copy of
+        graph if there is none.
+        """
+        record = self._graphs.get(id(graph))
+        if record is None:
+            if isinstance(graph, CSRGraph):
+                # The graph is not copied, so it costs nothing to hold
+                record = [self._next_version, graph, graph, 0, 0]
+            else:
+                csr_graph = CSRGraph(graph)
+                record = [self._next_version, graph, csr_graph, csr_bytes(csr_graph), 0]
+            self._next_version += 1
+            self._graphs[id(graph)] = record
+            self._bytes += record[3]
+        return record
+
+    def _drop(self, key):
+        """
+        Remove the result stored under key, and the record of its graph
+        if that was the graph's last result.
+        """
+        self._bytes -= array_bytes(self._entries.pop(key))
+        record = self._graphs[key[0]]
+        record[4] -= 1
+        if record[4] == 0:
+            self._release(key[0])
+
+    def _release(self, graph_key):
+        """
+        Remove the record of the graph with ID graph_key, if any.
+        """
+        record = self._graphs.pop(graph_key, None)
+        if record is not None:
+            self._bytes -= record[3]
+
+#cache = BFSCache()
+#print find_path(graph, 'Kevin Bacon', 'Tina Fey', cache.bfs(graph, 'Kevin Bacon')[1])
+#graph.add_edge('Kevin Bacon', 'Tina Fey', 'New Movie')
+#cache.add_edges(graph, [('Kevin Bacon', 'Tina Fey')])
+
+def distance_histogram(graph, node, cache=None, max_depth=None):
     """
     Given a graph and a node in that graph, returns a histogram
     (in the form of a dictionary mapping distance to counts) of
     the distances from node to every other node in the graph.
+
+    If max_depth is given, only nodes up to that distance are
+    searched and counted.  Otherwise, if a BFSCache is given, the
+    search is served from it.
     """
+    if max_depth is not None:
+        result_histogram = defaultdict(int)
+        for level, nodes in bfs_levels(graph, node, max_depth):
+            result_histogram[level] = len(nodes)
+        return result_histogram
+    if cache is not None:
+        result_histogram = defaultdict(int)
+        for distance in cache.get_arrays(graph, node)[1]:
+            result_histogram[distance_value(distance)] += 1
+        return result_histogram
+    if isinstance(graph, CSRGraph):
+        # The level sizes are the histogram already
+        level_sizes = direction_optimizing_bfs_ids(graph, graph.node_id(node))[2]
+        result_histogram = defaultdict(int)
+        for distance in range(len(level_sizes)):
+            result_histogram[distance] = level_sizes[distance]
+        unreached = len(graph) - sum(level_sizes)
+        if unreached:
+            result_histogram[float("inf")] = unreached
+        return result_histogram
     # Get the "dist" dictionary from bfs
     result_total= bfs(graph, node)
     result_distance = result_total[0]
@@ -106,6 +825,105 @@ def distance_histogram(graph, node):
         result_histogram[result_distance[key]] += 1
     return result_histogram
 
+# CSR arrays shared with the worker processes of separation_statistics
+SHARED_GRAPH = {}
+
+def init_separation_worker(offsets, neighbor_ids):
+    """
+    Remember the shared CSR arrays in a separation_statistics worker.
+    """
+    SHARED_GRAPH['offsets'] = offsets
+    SHARED_GRAPH['neighbor_ids'] = neighbor_ids
+
+def separation_chunk(source_ids):
+    """
+    Runs a breadth-first search from each actor ID in source_ids over
+    the shared graph.
+
+    Returns a two-element tuple of the combined histogram (a
+    dictionary mapping distance to counts) and a list of (source ID,
+    eccentricity) pairs.
+    """
+    offsets = SHARED_GRAPH['offsets']
+    neighbor_ids = SHARED_GRAPH['neighbor_ids']
+    histogram = defaultdict(int)
+    eccentricities = []
+    for source_id in source_ids:
+        dist = bfs_arrays(offsets, neighbor_ids, source_id)[0]
+        eccentricity = 0
+        for distance in dist:
+            if distance < 0:
+                histogram[float("inf")] += 1
+            else:
+                histogram[distance] += 1
+                eccentricity = max(eccentricity, distance)
+        eccentricities.append((source_id, eccentricity))
+    return dict(histogram), eccentricities
+
+def separation_statistics(graph, sources=None, samples=None, processes=None, seed=None):
+    """
+    Given a graph, runs a breadth-first search from many sources in a
+    pool of processes and combines the results.
+
+    The sources are the given list of actors, or a random sample of
+    samples actors (using seed), or otherwise every actor.  The graph
+    is copied once into shared memory that every worker reads.
+
+    Returns a dictionary with the keys "histogram" (the combined
+    distance histogram, as distance_histogram returns), "eccentricity"
+    (mapping each source to its largest finite distance) and "average"
+    (the average distance between distinct connected actors).
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph(graph)
+    if sources is None:
+        sources = graph.nodes()
+        if samples is not None:
+            sources = random.Random(seed).sample(sources, min(samples, len(sources)))
+    source_ids = [graph.node_id(source) for source in sources]
+    if processes is None:
+        processes = cpu_count()
+    offsets = RawArray('i', len(graph._offsets))
+    offsets[:] = graph._offsets
+    neighbor_ids = RawArray('i', len(graph._neighbor_ids))
+    neighbor_ids[:] = graph._neighbor_ids
+    # Four chunks per worker, so a worker that draws slow sources
+    # does not leave the others idle at the end
+    chunk_size = max(len(source_ids) // (processes * 4), 1)
+    chunks = [source_ids[start:start + chunk_size]
+              for start in range(0, len(source_ids), chunk_size)]
+    if processes <= 1:
+        init_separation_worker(offsets, neighbor_ids)
+        results = map(separation_chunk, chunks)
+    else:
+        pool = Pool(processes, init_separation_worker, (offsets, neighbor_ids))
+        try:
+            results = pool.map(separation_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    # Merge the partial results
+    histogram = defaultdict(int)
+    eccentricity = {}
+    for chunk_histogram, chunk_eccentricities in results:
+        for distance in chunk_histogram.keys():
+            histogram[distance] += chunk_histogram[distance]
+        for source_id, source_eccentricity in chunk_eccentricities:
+            eccentricity[graph.node_name(source_id)] = source_eccentricity
+    total_distance = 0
+    pairs = 0
+    for distance in histogram.keys():
+        if 0 < distance < float("inf"):
+            total_distance += distance * histogram[distance]
+            pairs += histogram[distance]
+    if pairs:
+        average = total_distance / float(pairs)
+    else:
+        average = float("inf")
+    return {"histogram": histogram, "eccentricity": eccentricity, "average": average}
+
+#print separation_statistics(movies.load_graph('subgraph5000'), samples=100, seed=0)["average"]
+
 def find_path(graph, start_person, end_person, parents):
     """
     Finds the path from start_person to end_person in the graph,
@@ -136,27 +954,718 @@ def find_path(graph, start_person, end_person, parents):
         count_index -= 1
     return path
 
-def play_kevin_bacon_game(graph, start_person, end_people):
+def bidirectional_bfs(graph, start_person, end_person, max_depth=None):
+    """
+    Finds a shortest path from start_person to end_person by searching
+    from both ends at once, expanding whichever frontier is smaller,
+    and stopping at the level where the two searches meet.
+
+    Returns the path in the same form as find_path, or an empty list
+    if there is no path (of at most max_depth steps, if given).
+    """
+    if start_person == end_person:
+        return [(start_person, set([]))]
+    # Parent and distance of every node each search has reached
+    parents = [{start_person: None}, {end_person: None}]
+    dists = [{start_person: 0}, {end_person: 0}]
+    frontiers = [[start_person], [end_person]]
+    best_length = float("inf")
+    best_meeting = None
+    if max_depth is None:
+        max_depth = float("inf")
+    levels = 0
+    while frontiers[0] and frontiers[1] and best_meeting is None and levels < max_depth:
+        levels += 1
+        # Expand one whole level of the smaller frontier
+        if len(frontiers[0]) <= len(frontiers[1]):
+            side = 0
+        else:
+            side = 1
+        own_parents = parents[side]
+        own_dists = dists[side]
+        other_dists = dists[1 - side]
+        next_frontier = []
+        for node in frontiers[side]:
+            for neighbor in graph.get_neighbors(node):
+                if neighbor in own_parents:
+                    continue
+                own_parents[neighbor] = node
+                own_dists[neighbor] = own_dists[node] + 1
+                next_frontier.append(neighbor)
+                # Keep the shortest meeting found on this level
+                if neighbor in other_dists:
+                    length = own_dists[neighbor] + other_dists[neighbor]
+                    if length < best_length:
+                        best_length = length
+                        best_meeting = neighbor
+        frontiers[side] = next_frontier
+    if best_meeting is None:
+        return []
+    # Walk back to the start, then forward to the end
+    nodes = []
+    now_node = best_meeting
+    while now_node is not None:
+        nodes.append(now_node)
+        now_node = parents[0][now_node]
+    nodes.reverse()
+    now_node = parents[1][best_meeting]
+    while now_node is not None:
+        nodes.append(now_node)
+        now_node = parents[1][now_node]
+    path = []
+    for index in range(len(nodes) - 1):
+        path.append((nodes[index], graph.get_attrs(nodes[index], nodes[index + 1])))
+    path.append((end_person, set([])))
+    return path
+
+def write_array(out_file, typecode, values):
+    """
+    Write values to out_file as little-endian 4-byte integers of the
+    array typecode ('i' or 'I'), straight from an array where possible
+    rather than through an argument tuple.
+    """
+    if not isinstance(values, array) or values.typecode != typecode:
+        values = array(typecode, values)
+    if sys.byteorder != 'little':
+        values = array(typecode, values)
+        values.byteswap()
+    values.tofile(out_file)
+
+# Landmark files start with LANDMARK_HEADER: magic, format version,
+# number of actors and number of landmarks.  The actor names follow,
+# then the landmark IDs and the distance table, all little-endian.
+LANDMARK_MAGIC = b'KBLM'
+LANDMARK_VERSION = 1
+LANDMARK_HEADER = struct.Struct('<4sIII')
+
+class LandmarkIndex:
+    """
+    Breadth-first search distances from a few landmark actors, used to
+    bound the distance between any two actors without searching.
+
+    By the triangle inequality, for every landmark L the distance
+    between a and b is at least |d(L, a) - d(L, b)| and at most
+    d(L, a) + d(L, b).
+    """
+
+    def __init__(self, graph=None, landmark_count=16, strategy="degree"):
+        """
+        Create an index over graph with landmark_count landmarks.  The
+        strategy "degree" picks the actors with the most neighbors;
+        "coverage" starts from the actor with the most neighbors and
+        then repeatedly picks the actor farthest from every landmark
+        so far.  With no graph the index is empty, ready for
+        load_landmarks.
+        """
+        self._names = []
+        self._ids = {}
+        self._landmarks = array('i')
+        # Distance from landmark i to actor j is at i * n + j, -1 if
+        # the actor cannot be reached
+        self._distances = array('i')
+        if graph is None:
+            return
+        self._names = list(graph.nodes())
+        for node_id in range(len(self._names)):
+            self._ids[self._names[node_id]] = node_id
+        landmark_count = min(landmark_count, len(self._names))
+        by_degree = sorted(self._names, key=lambda node: len(graph.get_neighbors(node)),
+                           reverse=True)
+        if strategy == "degree":
+            for node in by_degree[:landmark_count]:
+                self._add_landmark(graph, node)
+        elif strategy == "coverage":
+            if landmark_count:
+                self._add_landmark(graph, by_degree[0])
+                # Closest landmark distance of every actor; unreached
+                # actors count as farthest so other components get
+                # landmarks too
+                nearest = [self._stored_distance(0, node_id)
+                           for node_id in range(len(self._names))]
+            while len(self._landmarks) < landmark_count:
+                farthest = max(range(len(self._names)), key=lambda node_id: nearest[node_id])
+                self._add_landmark(graph, self._names[farthest])
+                landmark = len(self._landmarks) - 1
+                for node_id in range(len(self._names)):
+                    nearest[node_id] = min(nearest[node_id],
+                                           self._stored_distance(landmark, node_id))
+        else:
+            raise ValueError("unknown landmark strategy %r" % (strategy,))
+
+    def get_landmarks(self):
+        """
+        Return a list of the landmark actors.
+        """
+        return [self._names[node_id] for node_id in self._landmarks]
+
+    def bounds(self, node1, node2):
+        """
+        Return a two-element tuple of the lower and upper bounds on the
+        distance between node1 and node2.  The upper bound is infinite
+        if no landmark reaches both; both bounds are infinite if a
+        landmark reaches only one of them.
+        """
+        node_id1 = self._ids[node1]
+        node_id2 = self._ids[node2]
+        if node_id1 == node_id2:
+            return 0, 0
+        count = len(self._names)
+        lower = 0
+        upper = float("inf")
+        for landmark in range(len(self._landmarks)):
+            dist1 = self._distances[landmark * count + node_id1]
+            dist2 = self._distances[landmark * count + node_id2]
+            if dist1 < 0 and dist2 < 0:
+                continue
+            if dist1 < 0 or dist2 < 0:
+                # Different components
+                return float("inf"), float("inf")
+            lower = max(lower, abs(dist1 - dist2))
+            upper = min(upper, dist1 + dist2)
+        return lower, upper
+
+    def distance(self, graph, node1, node2):
+        """
+        Return the distance between node1 and node2 in graph.  When the
+        bounds meet this needs no search; otherwise a bidirectional
+        search looks only for paths shorter than the upper bound.
+        """
+        lower, upper = self.bounds(node1, node2)
+        if lower == upper:
+            return lower
+        if upper == float("inf"):
+            path = bidirectional_bfs(graph, node1, node2)
+        else:
+            path = bidirectional_bfs(graph, node1, node2, upper - 1)
+        if path:
+            return len(path) - 1
+        return upper
+
+    def _add_landmark(self, graph, node):
+        """
+        Add node as a landmark, storing its distance to every actor.
+        """
+        self._landmarks.append(self._ids[node])
+        dist = bfs(graph, node)[0]
+        for name in self._names:
+            if dist[name] == float("inf"):
+                self._distances.append(-1)
+            else:
+                self._distances.append(dist[name])
+
+    def _stored_distance(self, landmark, node_id):
+        """
+        Return the distance from the given landmark to node_id, which
+        is infinite if the actor cannot be reached.
+        """
+        stored = self._distances[landmark * len(self._names) + node_id]
+        if stored < 0:
+            return float("inf")
+        return stored
+
+def save_landmarks(index, path):
+    """
+    Save the LandmarkIndex index to the file at path.
+    """
+    index_file = open(path, 'wb')
+    try:
+        index_file.write(LANDMARK_HEADER.pack(LANDMARK_MAGIC, LANDMARK_VERSION,
+                                              len(index._names), len(index._landmarks)))
+        for name in index._names:
+            # Python 2 names are already byte strings
+            if isinstance(name, bytes):
+                encoded = name
+            else:
+                encoded = name.encode('utf-8')
+            index_file.write(struct.pack('<I', len(encoded)) + encoded)
+        for values in (index._landmarks, index._distances):
+            write_array(index_file, 'i', values)
+    finally:
+        index_file.close()
+
+def load_landmarks(path):
+    """
+    Load a LandmarkIndex saved by save_landmarks.
+    """
+    index_file = open(path, 'rb')
+    try:
+        data = index_file.read()
+    finally:
+        index_file.close()
+    magic, version, count, landmark_count = LANDMARK_HEADER.unpack_from(data, 0)
+    if magic != LANDMARK_MAGIC:
+        raise ValueError("%s is not a landmark index file" % path)
+    if version != LANDMARK_VERSION:
+        raise ValueError("%s has unsupported landmark file version %d" % (path, version))
+    offset = LANDMARK_HEADER.size
+    index = LandmarkIndex()
+    for node_id in range(count):
+        length = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        name = data[offset:offset + length]
+        offset += length
+        if not isinstance(name, str):
+            name = name.decode('utf-8')
+        index._names.append(name)
+        index._ids[name] = node_id
+    index._landmarks = array('i', struct.unpack_from('<%di' % landmark_count, data, offset))
+    offset += 4 * landmark_count
+    index._distances = array('i', struct.unpack_from('<%di' % (landmark_count * count), data, offset))
+    return index
+
+#index = LandmarkIndex(movies.load_graph('subgraph5000'), 8, "coverage")
+#print index.bounds('Kevin Bacon', 'Tina Fey')
+
+# Snapshot files start with SNAPSHOT_HEADER: magic, format version,
+# number of actors, number of neighbor entries, number of movies and
+# number of edge movie entries.  Then come the actor name table, the
+# actor IDs sorted by name, the CSR neighbor arrays, the CSR edge movie
+# arrays and the movie name table, all little-endian.  A name table is
+# n + 1 offsets followed by the UTF-8 names back to back.
+SNAPSHOT_MAGIC = b'KBGS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sIIIII')
+
+def mapped_array(buffer, offset, item_format, length):
+    """
+    Return a read-only array of length little-endian items of the
+    array typecode item_format, starting at offset in buffer.  Where
+    memoryviews can be cast the array is a view of the buffer, so
+    nothing is copied; otherwise the items are read into an array.
+    """
+    size = struct.calcsize('<' + item_format)
+    if sys.byteorder == 'little':
+        try:
+            return memoryview(buffer)[offset:offset + length * size].cast(item_format)
+        except (AttributeError, TypeError):
+            # Python 2 memoryviews cannot be cast
+            pass
+    values = array(item_format)
+    data = buffer[offset:offset + length * size]
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+def encode_name(name):
+    """
+    Return name as UTF-8 bytes; Python 2 names already are bytes.
+    """
+    if isinstance(name, bytes):
+        return name
+    return name.encode('utf-8')
+
+def decode_name(encoded):
+    """
+    Return encoded as a name of the platform's string type.
+    """
+    if isinstance(encoded, str):
+        return encoded
+    return encoded.decode('utf-8')
+
+class StringTable:
+    """
+    A read-only sequence of names stored in a snapshot name table,
+    decoded only when they are read.
+    """
+
+    def __init__(self, buffer, offset, length):
+        """
+        Create a view of the name table of length names starting at
+        offset in buffer.
+        """
+        self._buffer = buffer
+        self._offsets = mapped_array(buffer, offset, 'I', length + 1)
+        self._start = offset + 4 * (length + 1)
+
+    def __len__(self):
+        """
+        Return the number of names.
+        """
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        """
+        Return the name at index.
+        """
+        return decode_name(self.get_bytes(index))
+
+    def __iter__(self):
+        """
+        Iterate over the names.
+        """
+        for index in range(len(self)):
+            yield self[index]
+
+    def get_bytes(self, index):
+        """
+        Return the encoded name at index.
+        """
+        return self._buffer[self._start + self._offsets[index]:self._start + self._offsets[index + 1]]
+
+    def get_end(self):
+        """
+        Return the offset in the buffer just past the table.
+        """
+        return self._start + self._offsets[len(self)]
+
+class NameIndex:
+    """
+    A read-only mapping from actor name to ID over a snapshot, found by
+    binary search over the IDs sorted by name.
+    """
+
+    def __init__(self, names, sorted_ids):
+        """
+        Create an index of the StringTable names, given the IDs sorted
+        by encoded name.
+        """
+        self._names = names
+        self._sorted_ids = sorted_ids
+
+    def __getitem__(self, name):
+        """
+        Return the ID of the actor name.
+        """
+        node_id = self.get(name)
+        if node_id is None:
+            raise KeyError(name)
+        return node_id
+
+    def __contains__(self, name):
+        """
+        Return True if name is an actor in the snapshot.
+        """
+        return self.get(name) is not None
+
+    def __len__(self):
+        """
+        Return the number of actors.
+        """
+        return len(self._sorted_ids)
+
+    def get(self, name, default=None):
+        """
+        Return the ID of the actor name, or default if there is none.
+        """
+        encoded = encode_name(name)
+        low = 0
+        high = len(self._sorted_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self._names.get_bytes(self._sorted_ids[middle]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._sorted_ids) and self._names.get_bytes(self._sorted_ids[low]) == encoded:
+            return self._sorted_ids[low]
+        return default
+
+def write_name_table(snapshot_file, names):
+    """
+    Write a name table of the encoded names to snapshot_file.
+    """
+    offsets = array('I', [0])
+    for encoded in names:
+        offsets.append(offsets[-1] + len(encoded))
+    write_array(snapshot_file, 'I', offsets)
+    snapshot_file.write(b''.join(names))
+
+def save_snapshot(graph, path):
+    """
+    Save graph, an actor graph or CSRGraph, to a snapshot file at path.
+    The file is written under a temporary name and renamed into place,
+    so other processes never see it half written.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph(graph)
+    names = [encode_name(name) for name in graph._names]
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    snapshot_file = open(temporary_path, 'wb')
+    try:
+        snapshot_file.write(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(names), len(graph._neighbor_ids),
+            len(graph._movies), len(graph._edge_movies)))
+        write_name_table(snapshot_file, names)
+        sorted_ids = sorted(range(len(names)), key=lambda node_id: names[node_id])
+        for values in (sorted_ids, graph._offsets, graph._neighbor_ids,
+                       graph._movie_offsets, graph._edge_movies):
+            write_array(snapshot_file, 'i', values)
+        write_name_table(snapshot_file, [encode_name(movie) for movie in graph._movies])
+    finally:
+        snapshot_file.close()
+    os.rename(temporary_path, path)
+
+def open_snapshot(path):
+    """
+    Open a snapshot file saved by save_snapshot as a CSRGraph.  The file
+    is memory-mapped and names are decoded only when they are used, so
+    opening is quick and processes opening the same file share its
+    pages.
+    """
+    snapshot_file = open(path, 'rb')
+    try:
+        buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        snapshot_file.close()
+    magic, version, count, neighbor_count, movie_count, edge_movie_count = \
+        SNAPSHOT_HEADER.unpack_from(buffer, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("%s is not a graph snapshot file" % path)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError("%s has unsupported snapshot version %d" % (path, version))
+    graph = CSRGraph()
+    graph._names = StringTable(buffer, SNAPSHOT_HEADER.size, count)
+    offset = graph._names.get_end()
+    arrays = []
+    for length in (count, count + 1, neighbor_count, neighbor_count + 1, edge_movie_count):
+        arrays.append(mapped_array(buffer, offset, 'i', length))
+        offset += 4 * length
+    (sorted_ids, graph._offsets, graph._neighbor_ids,
+     graph._movie_offsets, graph._edge_movies) = arrays
+    graph._ids = NameIndex(graph._names, sorted_ids)
+    graph._movies = StringTable(buffer, offset, movie_count)
+    return graph
+
+def snapshot_path(name, source_path, directory='.'):
+    """
+    Return the path of the snapshot of the graph called name.  The
+    file name holds a hash of the name, the snapshot version and the
+    contents of source_path, the graph's source data file, so a
+    changed source gets a new snapshot.
+    """
+    digest = hashlib.sha1()
+    digest.update(encode_name(name))
+    digest.update(struct.pack('<I', SNAPSHOT_VERSION))
+    source_file = open(source_path, 'rb')
+    try:
+        block = source_file.read(1024 * 1024)
+        while block:
+            digest.update(block)
+            block = source_file.read(1024 * 1024)
+    finally:
+        source_file.close()
+    return os.path.join(directory, '%s.%s.kbgs' % (name, digest.hexdigest()[:16]))
+
+def load_graph_snapshot(name, source_path, directory='.'):
+    """
+    Load the graph called name as a CSRGraph from its snapshot,
+    loading it with movies.load_graph and writing the snapshot first
+    if there is none for the current contents of source_path, the
+    file movies.load_graph reads it from.  directory is created if it
+    does not exist.
+    """
+    path = snapshot_path(name, source_path, directory)
+    if not os.path.exists(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        save_snapshot(movies.load_graph(name), path)
+    return open_snapshot(path)
+
+def play_kevin_bacon_game(graph, start_person, end_people, cache=None):
     """
     Play the "Kevin Bacon Game" on the actors in the given
     graph, where startperson is the "Kevin Bacon"-esque
     actor from which the search will start and endpeople
     is a list of end people to which the search will be
-    performed.
+    performed.  If a BFSCache is given, the search is
+    served from it; otherwise it stops as soon as every
+    end person has been reached.
 
     Prints the results out.
     """
-    result_total = bfs(graph, start_person)
-    result_parents = result_total[1]
+    if cache is not None:
+        result_parents = cache.bfs(graph, start_person)[1]
+    else:
+        # Anyone the search never reached has no parent
+        result_parents = defaultdict(lambda: None)
+        remaining = set(end_people)
+        for level, nodes in bfs_levels(graph, start_person, parent=result_parents):
+            remaining.difference_update(nodes)
+            if not remaining:
+                break
     for end_person in end_people:
         print movies.print_path(find_path(graph, start_person, end_person, result_parents))
 
 
-def run():
+class CoalescingSearcher:
+    """
+    Runs breadth-first searches for many threads at once, letting
+    every request for the same start actor that arrives within window
+    seconds of the first share one bfs run.
+    """
+
+    def __init__(self, graph, window=0.005):
+        """
+        Create a searcher over graph with the given coalescing window.
+        """
+        self._graph = graph
+        self._window = window
+        self._lock = threading.Lock()
+        # Maps start actor to the [done event, result, error] of the
+        # search that requests can still join
+        self._pending = {}
+        self._searches = 0
+
+    def get_searches(self):
+        """
+        Return the number of bfs runs so far.
+        """
+        return self._searches
+
+    def bfs(self, start_node):
+        """
+        Returns the result of bfs on the graph from start_node, shared
+        with every other request for start_node in the same window.
+        """
+        self._lock.acquire()
+        try:
+            batch = self._pending.get(start_node)
+            leader = batch is None
+            if leader:
+                batch = [threading.Event(), None, None]
+                self._pending[start_node] = batch
+        finally:
+            self._lock.release()
+        if leader:
+            # Give other requests the window to join, then close the batch
+            time.sleep(self._window)
+            self._lock.acquire()
+            try:
+                del self._pending[start_node]
+                self._searches += 1
+            finally:
+                self._lock.release()
+            try:
+                batch[1] = bfs(self._graph, start_node)
+            except Exception as error:
+                batch[2] = error
+            batch[0].set()
+        else:
+            batch[0].wait()
+        if batch[2] is not None:
+            raise batch[2]
+        return batch[1]
+
+class KevinBaconHandler(socketserver.StreamRequestHandler):
+    """
+    Answers the queries of one client, one JSON object per line.
+    """
+
+    def handle(self):
+        """
+        Answer queries until the client disconnects.
+        """
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                response = self.server.answer(json.loads(line.decode('utf-8')))
+            except Exception as error:
+                response = {"error": repr(error)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+
+class KevinBaconServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A local server for Kevin Bacon Game queries, using only the
+    standard library.  Each line sent is a JSON query, answered with a
+    JSON line:
+
+    {"type": "path", "start": actor, "end": actor}
+        -> {"path": [[actor, [movies]], ...]}
+    {"type": "histogram", "start": actor}
+        -> {"histogram": {distance: count}}
+    {"type": "metrics"}
+        -> {"requests": n, "searches": n, "p50": seconds, "p99": seconds}
+
+    Every connection has its own thread, so the accept loop is never
+    held up by a search, and queries for the same start actor arriving
+    together share one bfs run through a CoalescingSearcher.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, graph, address=('127.0.0.1', 0), window=0.005):
+        """
+        Create a server for graph listening on address; port 0 picks a
+        free port, see server_address.
+        """
+        socketserver.TCPServer.__init__(self, address, KevinBaconHandler)
+        self._graph = graph
+        self._searcher = CoalescingSearcher(graph, window)
+        self._metrics_lock = threading.Lock()
+        self._requests = 0
+        # Latencies of the most recent queries, in seconds
+        self._latencies = deque(maxlen=10000)
+
+    def answer(self, query):
+        """
+        Return the response to query, a dictionary.
+        """
+        if query["type"] == "metrics":
+            return self.get_metrics()
+        if query["type"] not in ("path", "histogram"):
+            raise ValueError("unknown query type %r" % (query["type"],))
+        started = time.time()
+        dist, parent = self._searcher.bfs(query["start"])
+        if query["type"] == "path":
+            path = find_path(self._graph, query["start"], query["end"], parent)
+            response = {"path": [[actor, sorted(movies_shared)] for actor, movies_shared in path]}
+        else:
+            result_histogram = defaultdict(int)
+            for key in dist.keys():
+                result_histogram[str(dist[key])] += 1
+            response = {"histogram": result_histogram}
+        self._metrics_lock.acquire()
+        try:
+            self._requests += 1
+            self._latencies.append(time.time() - started)
+        finally:
+            self._metrics_lock.release()
+        return response
+
+    def get_metrics(self):
+        """
+        Return a dictionary of the number of queries answered, the
+        number of bfs runs, and the p50 and p99 query latencies in
+        seconds.
+        """
+        self._metrics_lock.acquire()
+        try:
+            latencies = sorted(self._latencies)
+            requests = self._requests
+        finally:
+            self._metrics_lock.release()
+        metrics = {"requests": requests, "searches": self._searcher.get_searches(),
+                   "p50": None, "p99": None}
+        if latencies:
+            metrics["p50"] = latencies[int(0.50 * (len(latencies) - 1))]
+            metrics["p99"] = latencies[int(0.99 * (len(latencies) - 1))]
+        return metrics
+
+#server = KevinBaconServer(load_graph_snapshot('subgraph5000', 'subgraph5000.txt'), ('127.0.0.1', 8140))
+#server.serve_forever()
+
+def run(snapshot_directory=None, source_path=None):
     """
     Load a graph and play the Kevin Bacon Game.
+
+    If snapshot_directory is given, the graph is loaded from a
+    snapshot kept there, keyed by the contents of source_path (the
+    file movies.load_graph reads subgraph5000 from), so only the first
+    run parses it.  Otherwise nothing is written to disk.
     """
-    graph5000 = movies.load_graph('subgraph5000')
+    if snapshot_directory is not None:
+        if source_path is None:
+            raise ValueError("a snapshot_directory needs the graph's source_path")
+        graph5000 = load_graph_snapshot('subgraph5000', source_path, snapshot_directory)
+    else:
+        graph5000 = movies.load_graph('subgraph5000')
 
     if len(graph5000.nodes()) > 0:
         # You can/should use smaller graphs and other actors while
@@ -174,4 +1683,6 @@ def run():
                 'Frequency', [hist], ["distance frequency"])
 
 # Uncomment the call to run below when you have completed your code.
+# To reuse a parsed graph between runs, call it as, for example,
+# run('snapshots', 'subgraph5000.txt') instead.
 run()
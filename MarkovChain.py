@@ -1,48 +1,591 @@
-from collections import defaultdict
-from random import random, randrange
+from array import array
+from bisect import bisect_left
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from random import Random, random, randrange
+import mmap
+import struct
+
+# Typecode for 64-bit unsigned context codes ('Q' is missing before 3.3)
+try:
+    CODE_TYPECODE = array('Q').typecode
+except ValueError:
+    CODE_TYPECODE = 'L'
 
 ### Model
 
+class MarkovModel:
+    """
+    A Markov chain of the given order that is built incrementally
+    from a stream of data.  Only the raw transition counts are kept,
+    so memory is bounded by the number of distinct states rather than
+    by the length of the data; probabilities are worked out when they
+    are first asked for.
+    """
+
+    def __init__(self, order, data=()):
+        """
+        Create a model of the given order, trained on data (any
+        iterable, including a generator).
+        """
+        self._order = order
+        # Maps each state tuple to a dictionary of next value -> count
+        self._counts = {}
+        # Probabilities and alias tables worked out so far, dropped
+        # when a state changes
+        self._probabilities = {}
+        self._tables = {}
+        # The last "order" values seen, carried over between updates
+        self._window = deque(maxlen=order)
+        self.update(data)
+
+    def __contains__(self, state):
+        """
+        Return True if state has been seen in the data.
+        """
+        return state in self._counts
+
+    def __getitem__(self, state):
+        """
+        Return a dictionary mapping each next value of state to its
+        probability.
+        """
+        return self.distribution(state)
+
+    def __len__(self):
+        """
+        Return the number of distinct states in the model.
+        """
+        return len(self._counts)
+
+    def keys(self):
+        """
+        Return the states seen in the data.
+        """
+        return self._counts.keys()
+
+    def get_order(self):
+        """
+        Return the order of the model.
+        """
+        return self._order
+
+    def update(self, new_values):
+        """
+        Extend the model with new_values, which may be any iterable.
+        Feeding the data in pieces gives the same model as feeding it
+        all at once.
+        """
+        order = self._order
+        window = self._window
+        counts = self._counts
+        probabilities = self._probabilities
+        tables = self._tables
+        for value in new_values:
+            # Only count a transition once the window holds a full state
+            if len(window) == order:
+                state = tuple(window)
+                next_counts = counts.get(state)
+                if next_counts is None:
+                    next_counts = {}
+                    counts[state] = next_counts
+                next_counts[value] = next_counts.get(value, 0) + 1
+                if state in probabilities:
+                    del probabilities[state]
+                if state in tables:
+                    del tables[state]
+            window.append(value)
+
+    def merge(self, other):
+        """
+        Add the transition counts of other, a MarkovModel of the same
+        order, to this model.  States new to this model are added in
+        the order other first saw them.
+        """
+        for state in other._counts.keys():
+            other_counts = other._counts[state]
+            next_counts = self._counts.get(state)
+            if next_counts is None:
+                next_counts = {}
+                self._counts[state] = next_counts
+            for value in other_counts.keys():
+                next_counts[value] = next_counts.get(value, 0) + other_counts[value]
+            if state in self._probabilities:
+                del self._probabilities[state]
+            if state in self._tables:
+                del self._tables[state]
+
+    def distribution(self, state):
+        """
+        Return a dictionary mapping each next value of state to its
+        probability.  Raises KeyError if state has not been seen.
+        """
+        probability = self._probabilities.get(state)
+        if probability is None:
+            next_counts = self._counts[state]
+            total_value = sum(next_counts.values())
+            probability = {}
+            for key in next_counts.keys():
+                probability[key] = next_counts[key] / float(total_value)
+            self._probabilities[state] = probability
+        return probability
+
+    def sample(self, state, rng=None):
+        """
+        Randomly return a next value of state, each with its
+        probability, drawing from rng (a random.Random) if given.  The
+        alias table for state is built on first use and reused until
+        the state is updated.
+        """
+        table = self._tables.get(state)
+        if table is None:
+            table = alias_table(self._counts[state])
+            self._tables[state] = table
+        return alias_sample(table, rng)
+
+    def as_dict(self):
+        """
+        Return the model in the same form as markov_chain, a dictionary
+        mapping each state to a dictionary of next value probabilities.
+        """
+        markov_dictionary = {}
+        for state in self._counts.keys():
+            markov_dictionary[state] = dict(self.distribution(state))
+        return markov_dictionary
+
+#model = MarkovModel(2, [1, 2, 3])
+#model.update([1, 2, 4])
+#print model.as_dict()
+
+class CompactMarkovModel:
+    """
+    A read-only Markov chain stored in flat arrays rather than nested
+    dictionaries.  Symbols are interned to integer IDs, each state is
+    encoded as a base-k number of its symbol IDs, and the transitions
+    of each state are stored CSR-style next to its alias table.
+    """
+
+    def __init__(self, model, order=None):
+        """
+        Create a compact copy of model, which may be a MarkovModel or a
+        dictionary returned by markov_chain.  The order is taken from
+        the model's states unless given.
+        """
+        states = list(model.keys())
+        if order is None:
+            if states:
+                order = len(states[0])
+            else:
+                order = 0
+        self._order = order
+        # Intern every symbol that appears in a state or as a next value
+        self._symbols = []
+        self._symbol_ids = {}
+        for state in states:
+            for value in state:
+                self._intern(value)
+            for value in model[state].keys():
+                self._intern(value)
+        self._base = max(len(self._symbols), 1)
+        if self._base ** order < 2 ** 64:
+            self._codes = array(CODE_TYPECODE)
+        else:
+            # Too many states for a machine word, fall back to long ints
+            self._codes = []
+        self._offsets = array('i', [0])
+        self._successors = array('i')
+        self._probabilities = array('d')
+        self._keep = array('d')
+        self._aliases = array('i')
+        # Store the states sorted by code so they can be found by bisection
+        coded_states = [(self._encode(state), state) for state in states]
+        coded_states.sort()
+        for code, state in coded_states:
+            self._codes.append(code)
+            distribution = model[state]
+            for value in distribution.keys():
+                self._successors.append(self._symbol_ids[value])
+                self._probabilities.append(distribution[value])
+            outcomes, keep, alias = alias_table(distribution)
+            for index in range(len(outcomes)):
+                self._keep.append(keep[index])
+                self._aliases.append(self._symbol_ids[alias[index]])
+            self._offsets.append(len(self._successors))
+
+    def __contains__(self, state):
+        """
+        Return True if state is in the model.
+        """
+        return self._find(state) >= 0
+
+    def __getitem__(self, state):
+        """
+        Return a dictionary mapping each next value of state to its
+        probability.  Raises KeyError if state is not in the model.
+        """
+        index = self._find(state)
+        if index < 0:
+            raise KeyError(state)
+        distribution = {}
+        for position in range(self._offsets[index], self._offsets[index + 1]):
+            value = self._symbols[self._successors[position]]
+            distribution[value] = self._probabilities[position]
+        return distribution
+
+    def __len__(self):
+        """
+        Return the number of states in the model.
+        """
+        return len(self._codes)
+
+    def keys(self):
+        """
+        Return the states in the model.
+        """
+        return [self._decode(code) for code in self._codes]
+
+    def get_order(self):
+        """
+        Return the order of the model.
+        """
+        return self._order
+
+    def sample(self, state, rng=None):
+        """
+        Randomly return a next value of state, each with its
+        probability, in constant time.  Draws from rng (a
+        random.Random) if given.  Raises KeyError if state is not in
+        the model.
+        """
+        index = self._find(state)
+        if index < 0:
+            raise KeyError(state)
+        start = self._offsets[index]
+        if rng is None:
+            position = random() * (self._offsets[index + 1] - start)
+        else:
+            position = rng.random() * (self._offsets[index + 1] - start)
+        column = int(position)
+        if position - column < self._keep[start + column]:
+            return self._symbols[self._successors[start + column]]
+        return self._symbols[self._aliases[start + column]]
+
+    def as_dict(self):
+        """
+        Return the model in the same form as markov_chain.
+        """
+        markov_dictionary = {}
+        for state in self.keys():
+            markov_dictionary[state] = self[state]
+        return markov_dictionary
+
+    def _intern(self, value):
+        """
+        Give value a symbol ID if it does not have one yet.
+        """
+        if value not in self._symbol_ids:
+            self._symbol_ids[value] = len(self._symbols)
+            self._symbols.append(value)
+
+    def _encode(self, state):
+        """
+        Return the base-k code of state, or -1 if it contains a symbol
+        that has never been seen.
+        """
+        code = 0
+        for value in state:
+            symbol_id = self._symbol_ids.get(value)
+            if symbol_id is None:
+                return -1
+            code = code * self._base + symbol_id
+        return code
+
+    def _decode(self, code):
+        """
+        Return the state with the given base-k code.
+        """
+        state = [None] * self._order
+        for position in range(self._order - 1, -1, -1):
+            code, symbol_id = divmod(code, self._base)
+            state[position] = self._symbols[symbol_id]
+        return tuple(state)
+
+    def _find(self, state):
+        """
+        Return the index of state in the model, or -1 if it is not in it.
+        """
+        if len(state) != self._order:
+            return -1
+        code = self._encode(state)
+        if code < 0:
+            return -1
+        index = bisect_left(self._codes, code)
+        if index < len(self._codes) and self._codes[index] == code:
+            return index
+        return -1
+
+#print CompactMarkovModel(MarkovModel(2, [1, 2, 3, 1, 2, 4])).as_dict()
+
+class SlidingMarkovModel:
+    """
+    A Markov chain of the given order over only the most recent
+    "window" values of a stream.  Each new value adds one transition
+    and evicts the one that falls out of the window, both in amortized
+    constant time, so the model follows recent behaviour without being
+    retrained.
+    """
+
+    def __init__(self, order, window, data=()):
+        """
+        Create a model of the given order over the last window values,
+        trained on data (any iterable).
+        """
+        self._order = order
+        # A window of N values holds N - order transitions
+        self._capacity = max(window - order, 0)
+        # The state of every transition in the window, oldest first
+        self._transitions = deque()
+        # Maps each state to a [start, next values] pair; the next
+        # values before start have been evicted
+        self._occurrences = {}
+        self._window = deque(maxlen=order)
+        self.update(data)
+
+    def __contains__(self, state):
+        """
+        Return True if state is in the window.
+        """
+        return state in self._occurrences
+
+    def __getitem__(self, state):
+        """
+        Return a dictionary mapping each next value of state to its
+        probability within the window.
+        """
+        start, values = self._occurrences[state]
+        total_value = float(len(values) - start)
+        distribution = {}
+        for position in range(start, len(values)):
+            value = values[position]
+            distribution[value] = distribution.get(value, 0) + 1
+        for key in distribution.keys():
+            distribution[key] = distribution[key] / total_value
+        return distribution
+
+    def __len__(self):
+        """
+        Return the number of distinct states in the window.
+        """
+        return len(self._occurrences)
+
+    def keys(self):
+        """
+        Return the states in the window.
+        """
+        return self._occurrences.keys()
+
+    def get_order(self):
+        """
+        Return the order of the model.
+        """
+        return self._order
+
+    def update(self, new_values):
+        """
+        Add new_values, which may be any iterable, to the window,
+        evicting the oldest transitions as they fall out of it.
+        """
+        order = self._order
+        window = self._window
+        transitions = self._transitions
+        occurrences = self._occurrences
+        for value in new_values:
+            if len(window) == order:
+                state = tuple(window)
+                entry = occurrences.get(state)
+                if entry is None:
+                    entry = [0, []]
+                    occurrences[state] = entry
+                entry[1].append(value)
+                transitions.append(state)
+                if len(transitions) > self._capacity:
+                    self._evict(transitions.popleft())
+            window.append(value)
+
+    def sample(self, state, rng=None):
+        """
+        Randomly return a next value of state, each with its
+        probability within the window, in constant time.  Draws from
+        rng (a random.Random) if given.
+        """
+        start, values = self._occurrences[state]
+        # Every occurrence is equally likely, which weights each next
+        # value by its count
+        if rng is None:
+            position = start + int(random() * (len(values) - start))
+        else:
+            position = start + int(rng.random() * (len(values) - start))
+        return values[position]
+
+    def _evict(self, state):
+        """
+        Remove the oldest transition out of state.
+        """
+        entry = self._occurrences[state]
+        entry[0] += 1
+        start, values = entry
+        if start == len(values):
+            del self._occurrences[state]
+        elif start > len(values) // 2:
+            # Drop the evicted values once they are the larger part
+            entry[0] = 0
+            entry[1] = values[start:]
+
+#model = SlidingMarkovModel(1, 4, [1, 2, 3, 1, 2, 4])
+#print model[(1,)], model[(2,)]
+
 def markov_chain(data, order):
     """
     Create a Markov chain with the given order from the
-    given list of data.
-    """
-    markov_dictionary = {}
-    # Look through all states included in data and build dictionary
-    for index1 in range(0, len(data) - order):
-        element_list = []
-        # Create a tuple out of the data
-        for index2 in range(0, order):
-            element_list.append(data[index1 + index2])
-        element_tuple = tuple(element_list)
-        # If the tuple is in the dictionary, then read off next
-        # value, if not then add a new key and read off next value
-        if element_tuple in markov_dictionary.keys():
-            markov_dictionary[element_tuple][data[index1 + order]] += 1
-        else:
-            markov_dictionary[element_tuple] = defaultdict(int)
-            markov_dictionary[element_tuple][data[index1 + order]] += 1
-    # Loop through all keys, turning numbers into probability
-    for key1 in markov_dictionary.keys():
-        markov_dictionary[key1] = dict(markov_dictionary[key1])
-        total_value = 0
-        for key2 in markov_dictionary[key1].keys():
-            total_value += markov_dictionary[key1][key2]
-        for key3 in markov_dictionary[key1].keys():
-            markov_dictionary[key1][key3] = markov_dictionary[key1][key3] / float(total_value)
-    return markov_dictionary
+    given data, which may be any iterable.
+    """
+    return MarkovModel(order, data).as_dict()
 
 #print markov_chain([1, 2, 3, 1, 2, 4], 2)
 
-def compare(dictionary):
+def count_chunk(chunk_order):
+    """
+    Count the transitions in a (chunk, order) pair, returning a
+    MarkovModel.  Used by the worker processes of
+    parallel_markov_chain.
+    """
+    chunk, order = chunk_order
+    return MarkovModel(order, chunk)
+
+def parallel_markov_chain(data, order, processes=None, chunk_size=None):
+    """
+    Create the same Markov chain as markov_chain from the given list
+    of data, counting transitions in a pool of processes.
+
+    The data is split into chunks of chunk_size transitions, each
+    overlapping the next by "order" elements so that no transition is
+    lost, and the partial counts are merged in order before they are
+    turned into probabilities.
+    """
+    if processes is None:
+        processes = cpu_count()
+    transitions = max(len(data) - order, 0)
+    if chunk_size is None:
+        # A few chunks per process keeps the pool busy to the end
+        chunk_size = max(transitions // (processes * 4), 1)
+    chunks = ((data[start:start + chunk_size + order], order)
+              for start in range(0, transitions, chunk_size))
+    model = MarkovModel(order)
+    if processes <= 1:
+        for chunk_model in map(count_chunk, chunks):
+            model.merge(chunk_model)
+        return model.as_dict()
+    pool = Pool(processes)
+    try:
+        for chunk_model in pool.imap(count_chunk, chunks):
+            model.merge(chunk_model)
+    finally:
+        pool.close()
+        pool.join()
+    return model.as_dict()
+
+#print parallel_markov_chain([1, 2, 3, 1, 2, 4, 1, 2, 3], 2, 2, 3)
+
+class ContextTree:
+    """
+    Transition counts for every order from 0 up to max_order, built
+    in a single pass over the data.  States are kept in a trie keyed
+    on the most recent value first, so the states of every order share
+    their common suffixes.
+    """
+
+    def __init__(self, max_order, data=()):
+        """
+        Create a context tree up to max_order, trained on data (any
+        iterable).
+        """
+        self._max_order = max_order
+        # Each node is a [children, next value counts] pair
+        self._root = [{}, {}]
+        # The last "max_order" values seen, carried over between updates
+        self._window = deque(maxlen=max_order)
+        self.update(data)
+
+    def get_max_order(self):
+        """
+        Return the highest order held in the tree.
+        """
+        return self._max_order
+
+    def update(self, new_values):
+        """
+        Extend the tree with new_values, which may be any iterable.
+        """
+        root = self._root
+        window = self._window
+        for value in new_values:
+            # Count value as the next value of every state ending here,
+            # from the empty state up to the longest one
+            node = root
+            next_counts = node[1]
+            next_counts[value] = next_counts.get(value, 0) + 1
+            for previous in reversed(window):
+                child = node[0].get(previous)
+                if child is None:
+                    child = [{}, {}]
+                    node[0][previous] = child
+                node = child
+                next_counts = node[1]
+                next_counts[value] = next_counts.get(value, 0) + 1
+            window.append(value)
+
+    def get_model(self, order):
+        """
+        Return the Markov chain of the given order, in the same form
+        as markov_chain returns, without rescanning the data.
+        """
+        if order > self._max_order:
+            raise ValueError("order %d is above the tree's maximum order %d"
+                             % (order, self._max_order))
+        markov_dictionary = {}
+        # Walk down to depth "order", remembering the path taken
+        stack = [(self._root, ())]
+        while stack:
+            node, reversed_state = stack.pop()
+            if len(reversed_state) == order:
+                next_counts = node[1]
+                # Only the root can be empty, before any data is seen
+                if not next_counts:
+                    continue
+                total_value = sum(next_counts.values())
+                probability = {}
+                for key in next_counts.keys():
+                    probability[key] = next_counts[key] / float(total_value)
+                markov_dictionary[tuple(reversed(reversed_state))] = probability
+            else:
+                for previous in node[0].keys():
+                    stack.append((node[0][previous], reversed_state + (previous,)))
+        return markov_dictionary
+
+#print ContextTree(2, [1, 2, 3, 1, 2, 4]).get_model(1)
+
+def compare(dictionary, rng=None):
     '''
     Randomly return a key in dictionary, the probability of any
-    key appearing equals to its value
+    key appearing equals to its value.  Draws from rng (a
+    random.Random) if given.
     '''
     new_list = []
     number = 0
-    random_number = random()
+    if rng is None:
+        random_number = random()
+    else:
+        random_number = rng.random()
     # Turn the dictionary into list
     for key in dictionary.keys():
         new_list.append(tuple([dictionary[key], key]))
@@ -62,15 +605,254 @@ def compare(dictionary):
 
 #print compare({1:0.2, 3:0.4, 5:0.6, 7:0.8, 9:0.8, 10:0.2})
 
+def alias_table(dictionary):
+    """
+    Build a Walker/Vose alias table for dictionary, which maps keys
+    to weights (probabilities or counts).  Returns a tuple of the
+    keys, the probability of keeping each column, and the key each
+    column falls back to.
+    """
+    outcomes = list(dictionary.keys())
+    number = len(outcomes)
+    total_weight = float(sum(dictionary.values()))
+    # Scale the weights so that the average column holds exactly 1
+    scaled = [dictionary[key] * number / total_weight for key in outcomes]
+    keep = [1.0] * number
+    alias = list(outcomes)
+    small = [index for index in range(number) if scaled[index] < 1.0]
+    large = [index for index in range(number) if scaled[index] >= 1.0]
+    # Top up every small column from a large one
+    while small and large:
+        index_small = small.pop()
+        index_large = large.pop()
+        keep[index_small] = scaled[index_small]
+        alias[index_small] = outcomes[index_large]
+        scaled[index_large] += scaled[index_small] - 1.0
+        if scaled[index_large] < 1.0:
+            small.append(index_large)
+        else:
+            large.append(index_large)
+    # Anything left over is full up to rounding error
+    return outcomes, keep, alias
+
+def alias_sample(table, rng=None):
+    """
+    Randomly return a key from an alias table built by alias_table,
+    in constant time.  Draws from rng (a random.Random) if given.
+    """
+    outcomes, keep, alias = table
+    if rng is None:
+        position = random() * len(outcomes)
+    else:
+        position = rng.random() * len(outcomes)
+    column = int(position)
+    if position - column < keep[column]:
+        return outcomes[column]
+    return alias[column]
+
+#print alias_sample(alias_table({1:0.2, 3:0.4, 5:0.4}))
+
+### Storage
+
+# Model files start with MODEL_HEADER: magic, format version, order,
+# number of symbols, number of states and number of transitions.
+# The symbol table follows, then the CompactMarkovModel arrays, all
+# little-endian.  Version 2 added the tag for byte string symbols.
+MODEL_MAGIC = b'MKVC'
+MODEL_VERSION = 2
+MODEL_HEADER = struct.Struct('<4sIIIQQ')
+# Number of array items packed per write
+WRITE_BLOCK = 65536
+# Symbol types that can be saved, including Python 2's long and unicode;
+# byte strings (Python 2's str) are saved apart from text strings
+try:
+    INTEGER_TYPES = (int, long)
+    TEXT_TYPES = (unicode,)
+except NameError:
+    INTEGER_TYPES = (int,)
+    TEXT_TYPES = (str,)
+
+class MappedArray:
+    """
+    A read-only view of an array of little-endian numbers stored in a
+    buffer such as a memory-mapped file.  Items are unpacked when they
+    are read, so the pages are shared and nothing is copied up front.
+    """
+
+    def __init__(self, buffer, offset, item_format, length):
+        """
+        Create a view of length items of the struct format item_format,
+        starting at offset in buffer.
+        """
+        self._buffer = buffer
+        self._offset = offset
+        self._item = struct.Struct('<' + item_format)
+        self._length = length
+
+    def __len__(self):
+        """
+        Return the number of items.
+        """
+        return self._length
+
+    def __getitem__(self, index):
+        """
+        Return the item at index.
+        """
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("MappedArray index out of range")
+        return self._item.unpack_from(self._buffer, self._offset + index * self._item.size)[0]
+
+    def __iter__(self):
+        """
+        Iterate over the items.
+        """
+        for index in range(self._length):
+            yield self[index]
+
+def write_array(model_file, item_format, values):
+    """
+    Write values to model_file as little-endian items of the struct
+    format item_format, returning the number of bytes written.
+    """
+    values = list(values)
+    for start in range(0, len(values), WRITE_BLOCK):
+        block = values[start:start + WRITE_BLOCK]
+        model_file.write(struct.pack('<%d%s' % (len(block), item_format), *block))
+    return len(values) * struct.calcsize('<' + item_format)
+
+def save_model(model, path):
+    """
+    Save model, which may be a MarkovModel, a CompactMarkovModel or a
+    dictionary returned by markov_chain, to the file at path.  Symbols
+    must be integers, floats, byte strings or text strings, and are
+    loaded back as the same type.
+    """
+    if not isinstance(model, CompactMarkovModel):
+        model = CompactMarkovModel(model)
+    if not isinstance(model._codes, array):
+        raise ValueError("model has too many possible states to save")
+    model_file = open(path, 'wb')
+    try:
+        model_file.write(MODEL_HEADER.pack(
+            MODEL_MAGIC, MODEL_VERSION, model._order, len(model._symbols),
+            len(model._codes), len(model._successors)))
+        # Each symbol is a one byte type tag followed by its value
+        for symbol in model._symbols:
+            if isinstance(symbol, INTEGER_TYPES) and -2 ** 63 <= symbol < 2 ** 63:
+                model_file.write(b'i' + struct.pack('<q', symbol))
+            elif isinstance(symbol, float):
+                model_file.write(b'f' + struct.pack('<d', symbol))
+            elif isinstance(symbol, bytes):
+                model_file.write(b'b' + struct.pack('<I', len(symbol)) + symbol)
+            elif isinstance(symbol, TEXT_TYPES):
+                encoded = symbol.encode('utf-8')
+                model_file.write(b's' + struct.pack('<I', len(encoded)) + encoded)
+            else:
+                raise ValueError("cannot save symbol %r" % (symbol,))
+        write_array(model_file, 'Q', model._codes)
+        write_array(model_file, 'i', model._offsets)
+        write_array(model_file, 'i', model._successors)
+        write_array(model_file, 'd', model._probabilities)
+        write_array(model_file, 'd', model._keep)
+        write_array(model_file, 'i', model._aliases)
+    finally:
+        model_file.close()
+
+def load_model(path):
+    """
+    Load a model saved by save_model, returning a CompactMarkovModel.
+    The file is memory-mapped and read lazily, so loading is quick and
+    processes loading the same file share its pages.
+    """
+    model_file = open(path, 'rb')
+    try:
+        buffer = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        model_file.close()
+    magic, version, order, symbol_count, state_count, transition_count = \
+        MODEL_HEADER.unpack_from(buffer, 0)
+    if magic != MODEL_MAGIC:
+        raise ValueError("%s is not a Markov model file" % path)
+    if version not in (1, MODEL_VERSION):
+        raise ValueError("%s has unsupported model file version %d" % (path, version))
+    offset = MODEL_HEADER.size
+    model = CompactMarkovModel({}, order)
+    for dummy in range(symbol_count):
+        tag = buffer[offset:offset + 1]
+        offset += 1
+        if tag == b'i':
+            symbol = struct.unpack_from('<q', buffer, offset)[0]
+            offset += 8
+        elif tag == b'f':
+            symbol = struct.unpack_from('<d', buffer, offset)[0]
+            offset += 8
+        elif tag in (b's', b'b'):
+            length = struct.unpack_from('<I', buffer, offset)[0]
+            offset += 4
+            symbol = buffer[offset:offset + length]
+            if tag == b's':
+                symbol = symbol.decode('utf-8')
+            offset += length
+        else:
+            raise ValueError("%s has an unknown symbol type %r" % (path, tag))
+        model._intern(symbol)
+    model._base = max(symbol_count, 1)
+    arrays = []
+    for item_format, length in [('Q', state_count), ('i', state_count + 1),
+                                ('i', transition_count), ('d', transition_count),
+                                ('d', transition_count), ('i', transition_count)]:
+        arrays.append(MappedArray(buffer, offset, item_format, length))
+        offset += length * struct.calcsize('<' + item_format)
+    (model._codes, model._offsets, model._successors,
+     model._probabilities, model._keep, model._aliases) = arrays
+    return model
+
+#save_model(markov_chain([1, 2, 3, 1, 2, 4], 2), 'model.mkv')
+#print load_model('model.mkv').as_dict()
+
 ### Predict
 
-def predict(model, last, num):
+def model_sampler(model):
+    """
+    Return a function that takes a state of model and an rng (a
+    random.Random, or None for the random module) and randomly returns
+    a next value of the state.  Models that can sample for themselves
+    do so; plain dictionaries get alias tables built on first use and
+    cached in the function.
+    """
+    sample = getattr(model, 'sample', None)
+    if sample is not None:
+        return sample
+    tables = {}
+    def sample(state, rng):
+        """
+        Randomly return a next value of state from its alias table.
+        """
+        table = tables.get(state)
+        if table is None:
+            table = alias_table(model[state])
+            tables[state] = table
+        return alias_sample(table, rng)
+    return sample
+
+def predict(model, last, num, rng=None):
     """
     Predict the next num values given the model and the last values.
+    Draws from rng (a random.Random) if given, otherwise from the
+    random module.
     """
     total_list = list(last)
     start_number = 0 - len(last)
     time = 0
+    # Every state samples from a cached table instead of a linear scan
+    sample = model_sampler(model)
+    if rng is None:
+        fallback = randrange
+    else:
+        fallback = rng.randrange
 #    print start_number
 #    print total_list
 #    print total_list[start_number:]
@@ -81,13 +863,13 @@ def predict(model, last, num):
 #        print 'This time, total_list is', total_list
         element_tuple = tuple(total_list[start_number:])
 #        print 'This time, element_tuple is', element_tuple
-        if element_tuple in model.keys():
+        if element_tuple in model:
 #            print 'In dictionary'
 #            print 'The number added is', compare(model[element_tuple])
-            total_list.append(compare(model[element_tuple]))
+            total_list.append(sample(element_tuple, rng))
         else:
 #            print 'Not in dictionary, random number generated'
-            total_list.append(randrange(0, 4))
+            total_list.append(fallback(0, 4))
 #    print 'In the end, total_list is', total_list
     return_number = 0 - num
     return total_list[return_number:]
@@ -95,6 +877,36 @@ def predict(model, last, num):
 
 #print predict(markov_chain([1, 2, 3, 1, 2, 4], 3), [1, 2, 3], 12)
 
+def predict_batch(model, last, num, trials, rng=None):
+    """
+    Predict the next num values given the model and the last values,
+    for the given number of independent trials at once.  Returns a
+    list with one prediction of num values per trial.  Draws from rng
+    (a random.Random) if given, otherwise from the random module.
+    """
+    width = len(last)
+    sample = model_sampler(model)
+    if rng is None:
+        fallback = randrange
+    else:
+        fallback = rng.randrange
+    states = [tuple(last)] * trials
+    predictions = [[0] * num for dummy in range(trials)]
+    # Fill in one step of every trial before moving on to the next step
+    for step in range(num):
+        for trial in range(trials):
+            state = states[trial]
+            if state in model:
+                value = sample(state, rng)
+            else:
+                value = fallback(0, 4)
+            predictions[trial][step] = value
+            if width:
+                states[trial] = state[1:] + (value,)
+    return predictions
+
+#print predict_batch(markov_chain([1, 2, 3, 1, 2, 4], 3), [1, 2, 3], 12, 4)
+
 
 
 ### Error
@@ -111,10 +923,71 @@ def mse(result, expected):
 
 #print mse([1, 2, 3], [2, 3, 5])
 
+def mean_mse(results, expected):
+    """
+    Calculate the average, over every sequence in results, of the
+    mean squared error between that sequence and expected.  The
+    sequences all have the same length, which may be shorter than
+    expected.
+    """
+    total_square_sum = 0
+    for result in results:
+        for index1 in range(0, len(result)):
+            total_square_sum += (result[index1] - expected[index1]) ** 2
+    return total_square_sum / float(len(results) * len(results[0]))
+
+#print mean_mse([[1, 2, 3], [2, 2, 5]], [2, 3, 5])
+
+def expected_mse(model, last, future, actual):
+    """
+    Calculate the exact expected mean squared error between the next
+    "future" values predicted from the model and the last values, and
+    actual.  This is the value run_experiment estimates by sampling,
+    worked out by pushing the probability of every state forward one
+    step at a time instead.
+
+    The number of states carried forward grows with the alphabet size
+    to the power of the order, so this suits small alphabets.
+    """
+    width = len(last)
+    # States missing from the model predict 0 through 3 uniformly
+    fallback = [(value, 0.25) for value in range(0, 4)]
+    transitions = {}
+    states = {tuple(last): 1.0}
+    total_square_sum = 0.0
+    for step in range(future):
+        expected = actual[step]
+        last_step = step == future - 1
+        next_states = {}
+        for state in states.keys():
+            probability = states[state]
+            moves = transitions.get(state)
+            if moves is None:
+                if state in model:
+                    distribution = model[state]
+                    moves = [(value, distribution[value]) for value in distribution.keys()]
+                else:
+                    moves = fallback
+                transitions[state] = moves
+            for value, move_probability in moves:
+                mass = probability * move_probability
+                total_square_sum += mass * (value - expected) ** 2
+                if last_step:
+                    continue
+                if width:
+                    next_state = state[1:] + (value,)
+                else:
+                    next_state = state
+                next_states[next_state] = next_states.get(next_state, 0.0) + mass
+        states = next_states
+    return total_square_sum / float(future)
+
+#print expected_mse(markov_chain([1, 2, 3, 1, 2, 4], 2), [1, 2], 3, [3, 1, 2])
+
 
 ### Experiment
 
-def run_experiment(train, order, test, future, actual, trials):
+def run_experiment(train, order, test, future, actual, trials, rng=None):
     """
     Run an experiment to predict the future of the test
     data given the training data.  Returns the average
@@ -126,12 +999,82 @@ def run_experiment(train, order, test, future, actual, trials):
     future - number of days to predict
     actual - actual results for next "future" days
     trials - number of trials to run
+    rng    - random.Random to draw from, instead of the random module
     """
-    total_mse = 0
-    time = 0
-    while time < trials:
-        time += 1
-        total_mse += mse(predict(markov_chain(train, order), test, future), actual)
-    return total_mse / float(trials)
+    # Train once and run every trial against the same model
+    model = MarkovModel(order, train)
+    return mean_mse(predict_batch(model, test, future, trials, rng), actual)
 
 #print run_experiment([1, 2, 3, 1, 2, 4, 1, 3, 4, 3, 1, 2, 4, 3], 3, [1, 2, 3], 5, [1, 3, 2, 4, 3], 10)
+
+def run_order_sweep(train, max_order, test, future, actual, trials, rng=None):
+    """
+    Run the experiment of run_experiment for every order from 1 to
+    max_order, scanning the training data only once.  Returns a
+    dictionary mapping each order to its average mean squared error.
+
+    test must hold at least max_order days of testing data; each
+    order uses the last "order" days of it.  Draws from rng (a
+    random.Random) if given.
+    """
+    tree = ContextTree(max_order, train)
+    results = {}
+    for order in range(1, max_order + 1):
+        model = tree.get_model(order)
+        last = test[len(test) - order:]
+        results[order] = mean_mse(predict_batch(model, last, future, trials, rng), actual)
+    return results
+
+#print run_order_sweep([1, 2, 3, 1, 2, 4, 1, 3, 4, 3, 1, 2, 4, 3], 3, [1, 2, 3], 5, [1, 3, 2, 4, 3], 10)
+
+def run_grid_config(indexed_config):
+    """
+    Run the experiment for one (index, configuration, seed) triple of
+    run_experiment_grid, returning the index and the result.  Used by
+    its worker processes.
+    """
+    index, config, seed = indexed_config
+    # The stream depends only on the seed and the configuration's
+    # position, never on which worker runs it
+    rng = Random(seed * 2 ** 32 + index)
+    return index, run_experiment(config['train'], config['order'], config['test'],
+                                 config['future'], config['actual'], config['trials'], rng)
+
+def run_experiment_grid(configs, processes=None, seed=0):
+    """
+    Run run_experiment for every configuration in configs, a list of
+    dictionaries with the keys "train", "order", "test", "future",
+    "actual" and "trials", spread over a pool of processes.
+
+    Yields (index, average mean squared error) pairs, where index is
+    the configuration's position in configs, as they finish.  Each
+    configuration draws from its own random.Random seeded from seed
+    and its index, so results are the same for any number of
+    processes.  Closing the generator early stops the remaining
+    configurations.
+    """
+    if processes is None:
+        processes = cpu_count()
+    indexed_configs = [(index, configs[index], seed) for index in range(len(configs))]
+    if processes <= 1:
+        for indexed_config in indexed_configs:
+            yield run_grid_config(indexed_config)
+        return
+    pool = Pool(processes)
+    finished = False
+    try:
+        for result in pool.imap_unordered(run_grid_config, indexed_configs):
+            yield result
+        finished = True
+    finally:
+        # If the caller stopped early, drop the configurations not yet
+        # run instead of waiting for them
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+#config = {'train': [1, 2, 3, 1, 2, 4, 1, 3, 4, 3, 1, 2, 4, 3], 'order': 3, 'test': [1, 2, 3],
+#          'future': 5, 'actual': [1, 3, 2, 4, 3], 'trials': 10}
+#print sorted(run_experiment_grid([config, config], 2, 1))
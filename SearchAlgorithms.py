@@ -3,6 +3,9 @@ Map Search
 """
 
 import comp140_module7 as maps
+from array import array
+import heapq
+import pickle
 
 class Queue:
     """
@@ -103,34 +106,148 @@ class Stack:
 
 class PriorityQueue(Queue):
     """
-    An implementation of PriorityQueue
+    An implementation of PriorityQueue of (node, priority) tuples.
+
+    The tuples are kept in a binary heap with an index from each node
+    to its position, so push, pop, pop_node and decrease_key take
+    O(log n) time and exist takes O(1).  Tuples with equal priority
+    come out in the order they were pushed.
     """
+    def __init__(self):
+        """
+        Initialize the Priority Queue.
+        """
+        Queue.__init__(self)
+        # The heap holds [priority, push order, element_tuple] entries
+        self._positions = {}
+        self._push_count = 0
+
+    def __str__(self):
+        """
+        Returns a string representation of the Priority Queue, with the
+        tuples in the order they will be popped.
+        """
+        entries = sorted(self._queue_list, key=lambda entry: (entry[0], entry[1]))
+        return str([entry[2] for entry in entries])
+
     def push(self, element_tuple):
         """
         This function pushes an element into Priority Queue
+
+        Assumes that the node is not in the Priority Queue yet; use
+        decrease_key to change the priority of a node already in it.
+        """
+        self._push_count += 1
+        self._queue_list.append([element_tuple[1], self._push_count, element_tuple])
+        self._positions[element_tuple[0]] = len(self._queue_list) - 1
+        self._sift_up(len(self._queue_list) - 1)
+
+    def pop(self):
+        """
+        Remove and return the element with the lowest priority.
+
+        Assumes that there is at least one element in the queue.
+        """
+        return self._remove(0)
+
+    def clear(self):
         """
-        self._queue_list.append(element_tuple)
-        # Sort the Priority Queue according to the second element of the tuple
-        self._queue_list.sort(key = lambda tuple : tuple[1])
+        Remove all items from the Priority Queue.
+        """
+        self._queue_list = []
+        self._positions = {}
 
     def exist(self, node):
         """
         This function checks whether a node is in Priority Queue
         """
-        for existing_element in self._queue_list:
-            if node == existing_element[0]:
-                return True
-        return False
+        return node in self._positions
 
     def pop_node(self, node):
         """
         Pop an element out of Priority Queue by node
         """
-        node_index = 0
-        for index in range(0, len(self._queue_list)):
-            if node == self._queue_list[index][0]:
-                node_index = index
-        return self._queue_list.pop(node_index)
+        return self._remove(self._positions[node])
+
+    def priority(self, node):
+        """
+        Return the priority of node, which must be in the Priority Queue
+        """
+        return self._queue_list[self._positions[node]][0]
+
+    def decrease_key(self, node, priority):
+        """
+        Lower the priority of node, which must be in the Priority Queue.
+        It is ordered among equal priorities as if it were pushed now.
+        """
+        index = self._positions[node]
+        entry = self._queue_list[index]
+        self._push_count += 1
+        entry[0] = priority
+        entry[1] = self._push_count
+        entry[2] = tuple([node, priority])
+        self._sift_up(index)
+
+    def _remove(self, index):
+        """
+        Remove and return the element at index in the heap
+        """
+        heap = self._queue_list
+        entry = heap[index]
+        del self._positions[entry[2][0]]
+        last_entry = heap.pop()
+        if index < len(heap):
+            # Fill the hole with the last entry and restore the heap
+            heap[index] = last_entry
+            self._positions[last_entry[2][0]] = index
+            self._sift_up(index)
+            self._sift_down(self._positions[last_entry[2][0]])
+        return entry[2]
+
+    # Entries are compared by priority, then by push order; no two
+    # entries have the same push order, so they are never equal
+
+    def _sift_up(self, index):
+        """
+        Move the entry at index up until its parent is not larger
+        """
+        heap = self._queue_list
+        entry = heap[index]
+        while index > 0:
+            parent_index = (index - 1) // 2
+            parent_entry = heap[parent_index]
+            if parent_entry[0] < entry[0] or (parent_entry[0] == entry[0]
+                                              and parent_entry[1] < entry[1]):
+                break
+            heap[index] = parent_entry
+            self._positions[parent_entry[2][0]] = index
+            index = parent_index
+        heap[index] = entry
+        self._positions[entry[2][0]] = index
+
+    def _sift_down(self, index):
+        """
+        Move the entry at index down until no child is smaller
+        """
+        heap = self._queue_list
+        entry = heap[index]
+        while True:
+            child_index = 2 * index + 1
+            if child_index >= len(heap):
+                break
+            if child_index + 1 < len(heap):
+                left = heap[child_index]
+                right = heap[child_index + 1]
+                if right[0] < left[0] or (right[0] == left[0] and right[1] < left[1]):
+                    child_index += 1
+            child = heap[child_index]
+            if entry[0] < child[0] or (entry[0] == child[0] and entry[1] < child[1]):
+                break
+            heap[index] = child
+            self._positions[child[2][0]] = index
+            index = child_index
+        heap[index] = entry
+        self._positions[entry[2][0]] = index
 
 #test_priority = PriorityQueue()
 #test_priority.push(tuple([1, 2]))
@@ -138,8 +255,143 @@ class PriorityQueue(Queue):
 #test_priority.push(tuple([2, 3]))
 #print str(test_priority)
 
+class SearchWorkspace:
+    """
+    Reusable per-node storage for repeated searches on one graph.
+
+    Each node's distance and parent live in lists indexed by an
+    interned node id, stamped with the epoch they were written in.
+    Starting a new search just bumps the epoch, so it costs O(1) instead
+    of a pass over every node, and entries from earlier searches read
+    as their defaults.
+    """
+
+    def __init__(self, graph):
+        """
+        Allocate storage for every node of graph.
+        """
+        nodes = list(graph.nodes())
+        self._ids = {}
+        for node_id in range(len(nodes)):
+            self._ids[nodes[node_id]] = node_id
+        self._stamps = [0] * len(nodes)
+        self._distances = [float("inf")] * len(nodes)
+        self._parents = [None] * len(nodes)
+        self._epoch = 0
+        self._touched = []
+
+    def reset(self):
+        """
+        Start a new search, forgetting all distances and parents.
+        Views returned before the reset see the new search.
+        """
+        self._epoch += 1
+        self._touched = []
+
+    def get_distances(self):
+        """
+        Return a dictionary-like view of the distances in this search,
+        with infinity for the nodes not reached yet.
+        """
+        return WorkspaceMap(self, self._distances, float("inf"))
+
+    def get_parents(self):
+        """
+        Return a dictionary-like view of the parents in this search,
+        with None for the nodes not reached yet.
+        """
+        return WorkspaceMap(self, self._parents, None)
+
+    def _touch(self, node):
+        """
+        Return the id of node, first resetting its entries if they were
+        written in an earlier search.
+        """
+        node_id = self._ids[node]
+        if self._stamps[node_id] != self._epoch:
+            self._stamps[node_id] = self._epoch
+            self._distances[node_id] = float("inf")
+            self._parents[node_id] = None
+            self._touched.append(node)
+        return node_id
+
+class WorkspaceMap:
+    """
+    A dictionary-like view of one list of a SearchWorkspace.
+
+    Every node of the graph can be read, and reads as the default until
+    it is written in the current search.  Membership, iteration and
+    len only cover the nodes written in the current search.
+    """
+
+    def __init__(self, workspace, values, default):
+        """
+        Create a view of values, a list in workspace.
+        """
+        self._workspace = workspace
+        self._values = values
+        self._default = default
+
+    def __getitem__(self, node):
+        """
+        Return the value of node, or the default if it is untouched.
+        """
+        node_id = self._workspace._ids[node]
+        if self._workspace._stamps[node_id] != self._workspace._epoch:
+            return self._default
+        return self._values[node_id]
+
+    def __setitem__(self, node, value):
+        """
+        Set the value of node.
+        """
+        self._values[self._workspace._touch(node)] = value
+
+    def __contains__(self, node):
+        """
+        Return whether node was touched in the current search.
+        """
+        node_id = self._workspace._ids.get(node)
+        return node_id is not None and self._workspace._stamps[node_id] == self._workspace._epoch
+
+    def __iter__(self):
+        """
+        Iterate over the nodes touched in the current search.
+        """
+        return iter(self._workspace._touched)
+
+    def __len__(self):
+        """
+        Return the number of nodes touched in the current search.
+        """
+        return len(self._workspace._touched)
+
+    def get(self, node, default=None):
+        """
+        Return the value of node if it was touched, else default.
+        """
+        if node in self:
+            return self[node]
+        return default
+
+    def keys(self):
+        """
+        Return a list of the nodes touched in the current search.
+        """
+        return list(self._workspace._touched)
+
+    def items(self):
+        """
+        Return a list of (node, value) pairs for the touched nodes.
+        """
+        return [(node, self[node]) for node in self._workspace._touched]
+
+#workspace = SearchWorkspace(graph)
+#print bfs_dfs(graph, Queue, start_node, end_node, workspace)
+#print astar(graph, start_node, end_node, edge_distance, straight_line_distance, workspace)
+
 
-def bfs_dfs(graph, rac_class, start_node, end_node):
+def bfs_dfs(graph, rac_class, start_node, end_node, workspace=None):
     """
     Performs a breadth-first search or a depth-first search on graph
     starting at the start_node.  The rac_class should either be a
@@ -149,15 +401,22 @@ def bfs_dfs(graph, rac_class, start_node, end_node):
     searched.
 
     Returns a dictionary associating each visited node with its parent
-    node.
+    node.  If a SearchWorkspace for graph is given, the search uses it
+    instead of initialising every node, and returns its parents view,
+    which is only valid until the workspace is used again.
     """
     rac_object = rac_class()
-    dist = {}
-    parent = {}
-    # Initialise all the information for nodes
-    for node in graph.nodes():
-        dist[node] = float("inf")
-        parent[node] = None
+    if workspace is not None:
+        workspace.reset()
+        dist = workspace.get_distances()
+        parent = workspace.get_parents()
+    else:
+        dist = {}
+        parent = {}
+        # Initialise all the information for nodes
+        for node in graph.nodes():
+            dist[node] = float("inf")
+            parent[node] = None
     dist[start_node] = 0
     rac_object.push(start_node)
     # Below is the core algorithm for Bread First Search/Depth First Search
@@ -175,38 +434,40 @@ def bfs_dfs(graph, rac_class, start_node, end_node):
 
 def dfs(graph, start_node, end_node, parent):
     """
-    Performs a recursive depth-first search on graph starting at the
-    start_node.
+    Performs a depth-first search on graph starting at the start_node.
+    It visits nodes in the same order as a recursive search, but keeps
+    its own stack, so long paths cannot exceed the recursion limit.
 
     Completes when end_node is found or entire graph has been
     searched.
 
     Modifies parent dictionary to associate each visited node with its
     parent node.  Assumes that parent initially has one entry that
-    associates the original start_node with None.
+    associates the original start_node with None.  parent may also be
+    the parents view of a freshly reset SearchWorkspace.
     """
-    # Check whether all the neighhbors in start_node is in parent already
-    all_inside_indicator = True
-    for neighbor in graph.get_neighbors(start_node):
-        if not (neighbor in parent.keys()):
-            all_inside_indicator = False
-    # Two base cases below:
     # If we already reached the end node, then return parent
     if start_node == end_node:
         return parent
-    # If all the neighbors in start_node is already in parent, that means this
-    # way cannot take us to end node
-    elif all_inside_indicator == True:
-        return parent
-    # Recursive case below:
-    for neighbor in graph.get_neighbors(start_node):
-        if not (neighbor in parent.keys()):
-            parent[neighbor] = start_node
-            dfs(graph, neighbor, end_node, parent)
+    # Each frame holds a node and an iterator over the neighbors it has
+    # yet to try, just like a recursive call part way through its loop
+    stack = [(start_node, iter(graph.get_neighbors(start_node)))]
+    while stack:
+        node, neighbors = stack[-1]
+        for neighbor in neighbors:
+            if neighbor not in parent:
+                parent[neighbor] = node
+                if neighbor == end_node:
+                    return parent
+                stack.append((neighbor, iter(graph.get_neighbors(neighbor))))
+                break
+        else:
+            # All the neighbors have been tried, so go back up
+            stack.pop()
     return parent
 
 def astar(graph, start_node, end_node,
-          edge_distance, straight_line_distance):
+          edge_distance, straight_line_distance, workspace=None):
     """
     Performs an A* search on graph starting at start_node.
 
@@ -220,20 +481,27 @@ def astar(graph, start_node, end_node,
     searched.
 
     Returns a dictionary associating each visited node with its parent
-    node.
+    node.  If a SearchWorkspace for graph is given, the search uses it
+    instead of initialising every node, and returns its parents view,
+    which is only valid until the workspace is used again.
     """
     # Open set is an priority queue
     open_set = PriorityQueue()
     # Claose set is a set. We only need to check whether a certain node is in it
     close_set = set([])
-    # We also need a place to store g cost
-    g_cost_storage = {}
-    # Below is the parent dictionary
-    parent = {}
-    # Initialise all nodes in parent and g_cost_storage
-    for node in graph.nodes():
-        parent[node] = None
-        g_cost_storage[node] = float("inf")
+    if workspace is not None:
+        workspace.reset()
+        g_cost_storage = workspace.get_distances()
+        parent = workspace.get_parents()
+    else:
+        # We also need a place to store g cost
+        g_cost_storage = {}
+        # Below is the parent dictionary
+        parent = {}
+        # Initialise all nodes in parent and g_cost_storage
+        for node in graph.nodes():
+            parent[node] = None
+            g_cost_storage[node] = float("inf")
     # Set inital values for the start_node
     g_cost_storage[start_node] = 0
     initial_distance = straight_line_distance(start_node, end_node, graph)
@@ -254,16 +522,17 @@ def astar(graph, start_node, end_node,
             # f cost from previous path and f cost from current path. The path
             # that gives a smaller f cost should remain
             elif open_set.exist(neighbor):
-                original_tuple = open_set.pop_node(neighbor)
                 current_g_cost = g_cost_storage[now_node] + edge_distance(now_node, neighbor, graph)
                 current_h_cost = straight_line_distance(neighbor, end_node, graph)
                 current_f_cost = current_g_cost + current_h_cost
-                if current_f_cost < original_tuple[1]:
-                    open_set.push(tuple([neighbor, current_f_cost]))
+                if current_f_cost < open_set.priority(neighbor):
+                    open_set.decrease_key(neighbor, current_f_cost)
                     g_cost_storage[neighbor] = current_g_cost
                     parent[neighbor] = now_node
                 else:
-                    open_set.push(original_tuple)
+                    # Requeue it behind the nodes of equal f cost, so
+                    # ties are broken in the same order as always
+                    open_set.push(open_set.pop_node(neighbor))
             # If the node is neither in open set nor in close set, then we
             # reached this node for the first time. We will then calculate its
             # g cost and f cost, and push it into open_set and store its g cost
@@ -278,6 +547,371 @@ def astar(graph, start_node, end_node,
     return parent
 
 
+class ContractionHierarchy:
+    """
+    A contraction hierarchy over a static map, for fast repeated
+    shortest-path queries.
+
+    Preprocessing contracts the nodes one at a time, least important
+    first, adding a shortcut edge u -> w whenever removing v would
+    break the only shortest path u -> v -> w.  A query then searches
+    upwards in importance from both ends, and meets at the most
+    important node of the shortest path.
+    """
+
+    def __init__(self, graph=None, edge_distance=None, witness_limit=64):
+        """
+        Preprocess graph, weighting each edge with edge_distance (as
+        used by astar).  witness_limit bounds the nodes each witness
+        search may settle; a lower limit preprocesses faster but adds
+        more shortcuts.  With no graph the hierarchy is empty, ready for
+        load_hierarchy.
+        """
+        self._nodes = []
+        # Maps node -> {more important node: weight} for the edges out
+        # of node, and for the edges into node, respectively
+        self._upward = {}
+        self._downward = {}
+        # Maps each shortcut (u, w) to the node v it skips
+        self._middle = {}
+        if graph is None:
+            return
+        self._nodes = list(graph.nodes())
+        out_edges = {}
+        in_edges = {}
+        for node in self._nodes:
+            out_edges[node] = {}
+            in_edges[node] = {}
+        for node in self._nodes:
+            for neighbor in graph.get_neighbors(node):
+                if neighbor != node:
+                    weight = edge_distance(node, neighbor, graph)
+                    if weight < out_edges[node].get(neighbor, float("inf")):
+                        out_edges[node][neighbor] = weight
+                        in_edges[neighbor][node] = weight
+        self._witness_limit = witness_limit
+        contracted_neighbors = dict.fromkeys(self._nodes, 0)
+        # Order nodes by edge difference, updated lazily when popped
+        order_heap = []
+        for index in range(len(self._nodes)):
+            node = self._nodes[index]
+            priority = self._priority(node, out_edges, in_edges, contracted_neighbors)
+            order_heap.append((priority, index, node))
+        heapq.heapify(order_heap)
+        while order_heap:
+            priority, index, node = heapq.heappop(order_heap)
+            priority = self._priority(node, out_edges, in_edges, contracted_neighbors)
+            if order_heap and priority > order_heap[0][0]:
+                heapq.heappush(order_heap, (priority, index, node))
+                continue
+            self._contract(node, out_edges, in_edges, False)
+            # The remaining edges of node all lead to more important nodes
+            self._upward[node] = out_edges.pop(node)
+            self._downward[node] = in_edges.pop(node)
+            for neighbor in self._upward[node].keys():
+                del in_edges[neighbor][node]
+                contracted_neighbors[neighbor] += 1
+            for neighbor in self._downward[node].keys():
+                del out_edges[neighbor][node]
+                contracted_neighbors[neighbor] += 1
+
+    def query(self, start_node, end_node):
+        """
+        Find a shortest path from start_node to end_node.
+
+        Returns a dictionary associating each node on the path with its
+        parent, and the start node with None.  Unlike the dictionary
+        astar returns it leaves out every other node, so a query costs
+        nothing per node of the map; treat a missing node as having no
+        parent.
+        """
+        parent = {start_node: None}
+        path = self.shortest_path(start_node, end_node)
+        for index in range(1, len(path)):
+            parent[path[index]] = path[index - 1]
+        return parent
+
+    def shortest_path(self, start_node, end_node):
+        """
+        Return a list of the nodes on a shortest path from start_node to
+        end_node, or an empty list if there is none.
+        """
+        # Index 0 searches forward from the start, index 1 backward
+        # from the end, both only towards more important nodes
+        edges = [self._upward, self._downward]
+        dists = [{start_node: 0}, {end_node: 0}]
+        parents = [{start_node: None}, {end_node: None}]
+        heaps = [[(0, 0, start_node)], [(0, 0, end_node)]]
+        settled = [set([]), set([])]
+        push_count = 0
+        best_distance = float("inf")
+        meeting = None
+        while heaps[0] or heaps[1]:
+            # Stop once neither search can still find a shorter path
+            if min([heap[0][0] for heap in heaps if heap]) >= best_distance:
+                break
+            for side in (0, 1):
+                if not heaps[side]:
+                    continue
+                distance, dummy, node = heapq.heappop(heaps[side])
+                if node in settled[side]:
+                    continue
+                settled[side].add(node)
+                if node in dists[1 - side] and distance + dists[1 - side][node] < best_distance:
+                    best_distance = distance + dists[1 - side][node]
+                    meeting = node
+                for neighbor, weight in edges[side][node].items():
+                    if distance + weight < dists[side].get(neighbor, float("inf")):
+                        dists[side][neighbor] = distance + weight
+                        parents[side][neighbor] = node
+                        push_count += 1
+                        heapq.heappush(heaps[side], (distance + weight, push_count, neighbor))
+        if meeting is None:
+            return []
+        # Collect the edges from the start up to the meeting node and
+        # from there down to the end, then unpack their shortcuts
+        forward = []
+        node = meeting
+        while parents[0][node] is not None:
+            forward.append((parents[0][node], node))
+            node = parents[0][node]
+        forward.reverse()
+        node = meeting
+        while parents[1][node] is not None:
+            forward.append((node, parents[1][node]))
+            node = parents[1][node]
+        path = [start_node]
+        for edge in forward:
+            path.extend(self._unpack(edge))
+        return path
+
+    def _unpack(self, edge):
+        """
+        Return the nodes after the first along edge, replacing every
+        shortcut with the edges it skips.
+        """
+        nodes = []
+        stack = [edge]
+        while stack:
+            node1, node2 = stack.pop()
+            middle = self._middle.get((node1, node2))
+            if middle is None:
+                nodes.append(node2)
+            else:
+                stack.append((middle, node2))
+                stack.append((node1, middle))
+        return nodes
+
+    def _priority(self, node, out_edges, in_edges, contracted_neighbors):
+        """
+        Return the contraction priority of node: the shortcuts it needs
+        minus the edges it removes, plus its contracted neighbors.
+        """
+        shortcuts = self._contract(node, out_edges, in_edges, True)
+        return (shortcuts - len(out_edges[node]) - len(in_edges[node])
+                + contracted_neighbors[node])
+
+    def _contract(self, node, out_edges, in_edges, simulate):
+        """
+        Add the shortcuts needed to remove node from the remaining
+        graph, returning how many there are.  If simulate is True they
+        are only counted.
+        """
+        shortcuts = 0
+        for source, in_weight in list(in_edges[node].items()):
+            targets = {}
+            for target, out_weight in out_edges[node].items():
+                if target != source:
+                    targets[target] = in_weight + out_weight
+            if not targets:
+                continue
+            witness = self._witness_search(source, node, max(targets.values()), out_edges)
+            for target, via_distance in targets.items():
+                if witness.get(target, float("inf")) <= via_distance:
+                    continue
+                shortcuts += 1
+                if not simulate and via_distance < out_edges[source].get(target, float("inf")):
+                    out_edges[source][target] = via_distance
+                    in_edges[target][source] = via_distance
+                    self._middle[(source, target)] = node
+        return shortcuts
+
+    def _witness_search(self, source, excluded, max_distance, out_edges):
+        """
+        Return the distances from source to the nodes within
+        max_distance of it in the remaining graph without excluded,
+        settling at most witness_limit nodes.
+        """
+        dist = {source: 0}
+        heap = [(0, 0, source)]
+        settled = set([])
+        push_count = 0
+        while heap and len(settled) < self._witness_limit:
+            distance, dummy, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if distance > max_distance:
+                break
+            settled.add(node)
+            for neighbor, weight in out_edges[node].items():
+                if neighbor != excluded and distance + weight < dist.get(neighbor, float("inf")):
+                    dist[neighbor] = distance + weight
+                    push_count += 1
+                    heapq.heappush(heap, (distance + weight, push_count, neighbor))
+        return dist
+
+def save_hierarchy(hierarchy, path):
+    """
+    Save the ContractionHierarchy hierarchy to the file at path.
+    """
+    hierarchy_file = open(path, 'wb')
+    try:
+        pickle.dump({"version": 1, "nodes": hierarchy._nodes, "upward": hierarchy._upward,
+                     "downward": hierarchy._downward, "middle": hierarchy._middle},
+                    hierarchy_file, 2)
+    finally:
+        hierarchy_file.close()
+
+def load_hierarchy(path):
+    """
+    Load a ContractionHierarchy saved by save_hierarchy.
+    """
+    hierarchy_file = open(path, 'rb')
+    try:
+        state = pickle.load(hierarchy_file)
+    finally:
+        hierarchy_file.close()
+    if state.get("version") != 1:
+        raise ValueError("%s has an unsupported hierarchy version" % path)
+    hierarchy = ContractionHierarchy()
+    hierarchy._nodes = state["nodes"]
+    hierarchy._upward = state["upward"]
+    hierarchy._downward = state["downward"]
+    hierarchy._middle = state["middle"]
+    return hierarchy
+
+#hierarchy = ContractionHierarchy(graph, edge_distance)
+#save_hierarchy(hierarchy, 'map.ch')
+#print load_hierarchy('map.ch').query(start_node, end_node)
+
+
+class LandmarkHeuristic:
+    """
+    An ALT (A*, landmarks, triangle inequality) heuristic for astar,
+    called like straight_line_distance.
+
+    The shortest distances from and to a few landmark nodes are
+    precomputed.  For every landmark L, d(L, end) - d(L, node) and
+    d(node, L) - d(end, L) are lower bounds on d(node, end), so the
+    largest of them never overestimates and astar still finds shortest
+    paths.
+    """
+
+    def __init__(self, graph, edge_distance, landmarks=4, fallback=None):
+        """
+        Precompute the landmark distances for graph, weighting each edge
+        with edge_distance.  landmarks is either the number of landmarks
+        to pick, spread out as far from each other as possible, or a
+        list of the landmark nodes.  If fallback is given (for example
+        straight_line_distance), the heuristic is never smaller than it.
+        """
+        self._fallback = fallback
+        nodes = list(graph.nodes())
+        self._ids = {}
+        for node_id in range(len(nodes)):
+            self._ids[nodes[node_id]] = node_id
+        # Adjacency lists of (neighbor id, weight), and their reverse
+        forward = [[] for dummy in nodes]
+        backward = [[] for dummy in nodes]
+        for node in nodes:
+            node_id = self._ids[node]
+            for neighbor in graph.get_neighbors(node):
+                weight = edge_distance(node, neighbor, graph)
+                forward[node_id].append((self._ids[neighbor], weight))
+                backward[self._ids[neighbor]].append((node_id, weight))
+        if isinstance(landmarks, int):
+            landmark_ids = []
+            # Start far away from an arbitrary node, then repeatedly
+            # take the node furthest from all the landmarks so far
+            closest = self._dijkstra(forward, 0) if nodes else []
+            while len(landmark_ids) < min(landmarks, len(nodes)):
+                landmark_id = max(range(len(nodes)), key=closest.__getitem__)
+                landmark_ids.append(landmark_id)
+                distances = self._dijkstra(forward, landmark_id)
+                for node_id in range(len(nodes)):
+                    closest[node_id] = min(closest[node_id], distances[node_id])
+        else:
+            landmark_ids = [self._ids[node] for node in landmarks]
+        self._landmarks = [nodes[landmark_id] for landmark_id in landmark_ids]
+        # Row node_id of each table holds the distances for node_id, one
+        # column per landmark
+        count = len(landmark_ids)
+        self._from_landmarks = array('d', [0.0]) * (len(nodes) * count)
+        self._to_landmarks = array('d', [0.0]) * (len(nodes) * count)
+        for column in range(count):
+            from_distances = self._dijkstra(forward, landmark_ids[column])
+            to_distances = self._dijkstra(backward, landmark_ids[column])
+            for node_id in range(len(nodes)):
+                self._from_landmarks[node_id * count + column] = from_distances[node_id]
+                self._to_landmarks[node_id * count + column] = to_distances[node_id]
+        self._end_node = None
+        self._end_row = None
+
+    def __call__(self, node, end_node, graph):
+        """
+        Return a lower bound on the distance from node to end_node.
+        """
+        count = len(self._landmarks)
+        # astar asks about the same end_node over and over
+        if end_node != self._end_node or self._end_row is None:
+            end_id = self._ids[end_node]
+            self._end_row = (self._from_landmarks[end_id * count:(end_id + 1) * count],
+                             self._to_landmarks[end_id * count:(end_id + 1) * count])
+            self._end_node = end_node
+        end_from, end_to = self._end_row
+        node_id = self._ids[node]
+        node_from = self._from_landmarks[node_id * count:(node_id + 1) * count]
+        node_to = self._to_landmarks[node_id * count:(node_id + 1) * count]
+        infinity = float("inf")
+        bound = 0
+        for column in range(count):
+            # Bounds through unreachable landmarks say nothing
+            if end_from[column] != infinity and node_from[column] != infinity:
+                bound = max(bound, end_from[column] - node_from[column])
+            if node_to[column] != infinity and end_to[column] != infinity:
+                bound = max(bound, node_to[column] - end_to[column])
+        if self._fallback is not None:
+            bound = max(bound, self._fallback(node, end_node, graph))
+        return bound
+
+    def get_landmarks(self):
+        """
+        Return the list of landmark nodes.
+        """
+        return list(self._landmarks)
+
+    def _dijkstra(self, edges, source_id):
+        """
+        Return a list of the shortest distances from source_id to every
+        node id along edges, with infinity for unreachable nodes.
+        """
+        dist = [float("inf")] * len(edges)
+        dist[source_id] = 0
+        heap = [(0, source_id)]
+        while heap:
+            distance, node_id = heapq.heappop(heap)
+            if distance > dist[node_id]:
+                continue
+            for neighbor_id, weight in edges[node_id]:
+                if distance + weight < dist[neighbor_id]:
+                    dist[neighbor_id] = distance + weight
+                    heapq.heappush(heap, (distance + weight, neighbor_id))
+        return dist
+
+#heuristic = LandmarkHeuristic(graph, edge_distance, 8, straight_line_distance)
+#print astar(graph, start_node, end_node, edge_distance, heuristic)
+
+
 # You can replace functions/classes you have not yet implemented with
 # None in the call to "maps.start" below and the other elements will
 # work.